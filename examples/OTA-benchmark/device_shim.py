@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020, Pycom Limited.
+#
+# This software is licensed under the GNU GPL version 3 or any
+# later version, with permitted additional terms. For more information
+# see the Pycom Licence v1.0 document supplied with this file, or
+# available at https://www.pycom.io/opensource/licensing
+#
+
+# Host side stand-ins for the Pycom/MicroPython modules used by the WiFi OTA
+# library (`OTA.py`), so its download code can be run and measured against a
+# local server with CPython.
+#
+# Usage:
+#    import device_shim
+#    OTA = device_shim.load_ota('../OTA/1.0.1/flash/lib')
+#    ota = OTA.WiFiOTA('ssid', 'password', '127.0.0.1', 8000)
+
+import binascii
+import hashlib
+import importlib
+import json
+import socket as _socket
+import struct
+import sys
+import time
+import types
+import zlib
+
+
+# Counts the socket operations performed by the OTA library
+class SocketStats:
+
+    def __init__(self):
+        self.connects = 0
+        self.recv_calls = 0
+        self.bytes_received = 0
+
+    def reset(self):
+        self.__init__()
+
+
+stats = SocketStats()
+
+
+# CPython socket with the MicroPython `readinto` method, counting every
+# receive call.
+class MicroPythonSocket(_socket.socket):
+
+    def connect(self, address):
+        stats.connects += 1
+        super().connect(address)
+
+    def recv(self, bufsize):
+        data = super().recv(bufsize)
+        stats.recv_calls += 1
+        stats.bytes_received += len(data)
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        if nbytes is None:
+            nbytes = len(buf)
+        # MicroPython blocks until `nbytes` have been read or the connection
+        # is closed
+        view = memoryview(buf)
+        read = 0
+        while read < nbytes:
+            n = self.recv_into(view[read:nbytes])
+            stats.recv_calls += 1
+            if n == 0:
+                break
+            read += n
+        stats.bytes_received += read
+        return read
+
+
+# Firmware "partition" written by pycom.ota_write
+class FirmwareSink:
+
+    def __init__(self):
+        self.image = bytearray()
+        self.finished = False
+
+    def ota_start(self):
+        self.image = bytearray()
+        self.finished = False
+
+    def ota_write(self, data):
+        self.image.extend(data)
+
+    def ota_finish(self):
+        self.finished = True
+
+
+firmware = FirmwareSink()
+
+
+# uzlib.DecompIO on top of zlib
+class DecompIO:
+
+    def __init__(self, stream, wbits=0):
+        self._stream = stream
+        self._d = zlib.decompressobj(wbits)
+        self._buf = b''
+
+    def read(self, size):
+        while len(self._buf) < size and not self._d.eof:
+            block = self._stream.read(256)
+            if not block:
+                break
+            self._buf += self._d.decompress(block)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+# Registers the stand-in modules. Modules that already exist (e.g. when
+# running under MicroPython) are left untouched.
+def install():
+    if 'pycom' in sys.modules:
+        return
+
+    _module('network')
+    _module('machine',
+            idle=lambda: None,
+            reset=lambda: None,
+            unique_id=lambda: b'\x24\x0a\xc4\x00\x00\x01')
+    _module('pycom',
+            ota_start=firmware.ota_start,
+            ota_write=firmware.ota_write,
+            ota_finish=firmware.ota_finish)
+    _module('uhashlib', sha1=hashlib.sha1)
+    _module('ubinascii', hexlify=binascii.hexlify)
+    _module('ujson', loads=json.loads, dumps=json.dumps)
+    _module('ustruct', pack=struct.pack, unpack=struct.unpack)
+    _module('uzlib', DecompIO=DecompIO)
+    _module('utime',
+            time=time.time,
+            sleep=time.sleep,
+            sleep_ms=lambda ms: time.sleep(ms / 1000),
+            ticks_ms=lambda: int(time.monotonic() * 1000),
+            ticks_diff=lambda a, b: a - b)
+
+
+# Imports the OTA library found in `lib_path` with the stand-in modules and
+# counting sockets.
+def load_ota(lib_path):
+    install()
+    # The library is imported from a directory served by the OTA server, no
+    # bytecode is written there or it would be listed as an update file
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    sys.path.insert(0, lib_path)
+    try:
+        ota = importlib.import_module('OTA')
+    finally:
+        sys.path.remove(lib_path)
+        sys.dont_write_bytecode = dont_write_bytecode
+
+    ota.socket = types.SimpleNamespace(socket=MicroPythonSocket,
+                                       AF_INET=_socket.AF_INET,
+                                       SOCK_STREAM=_socket.SOCK_STREAM,
+                                       IPPROTO_TCP=_socket.IPPROTO_TCP)
+    return ota
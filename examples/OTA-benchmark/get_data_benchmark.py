@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020, Pycom Limited.
+#
+# This software is licensed under the GNU GPL version 3 or any
+# later version, with permitted additional terms. For more information
+# see the Pycom Licence v1.0 document supplied with this file, or
+# available at https://www.pycom.io/opensource/licensing
+#
+
+# Measures `WiFiOTA.get_data` of the WiFi OTA library on the host against a
+# minimal local HTTP/1.1 server.
+#
+# For every payload size the same file is downloaded repeatedly over one
+# keep-alive connection, into memory, into a file and into the (simulated)
+# firmware partition. The time per download, the throughput and the number of
+# socket receive calls per download are reported. The server sends its
+# responses in small segments so the HTTP header separator regularly ends up
+# split across two reads.
+#
+# Usage:
+#    python3 get_data_benchmark.py [--lib ../OTA/1.0.1/flash/lib]
+#                                  [--sizes 1024,65536,1572864]
+#                                  [--repeat 20]
+
+import argparse
+import contextlib
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import device_shim
+
+DEFAULT_LIB = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'OTA', '1.0.1', 'flash', 'lib')
+
+
+# Serves `payload` for every GET request on a keep-alive connection, written
+# in `segment` sized pieces
+class PayloadServer:
+
+    def __init__(self, payload, segment=1460):
+        self.payload = payload
+        self.segment = segment
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        self._th = threading.Thread(target=self._serve, daemon=True)
+        self._th.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,),
+                             daemon=True).start()
+
+    def _handle(self, conn):
+        response = b'HTTP/1.1 200 OK\r\nContent-Length: ' + \
+            str(len(self.payload)).encode() + b'\r\n\r\n' + self.payload
+        data = b''
+        with conn:
+            while True:
+                while b'\r\n\r\n' not in data:
+                    chunk = conn.recv(1024)
+                    if not chunk:
+                        return
+                    data += chunk
+                data = data.split(b'\r\n\r\n', 1)[1]
+                for i in range(0, len(response), self.segment):
+                    conn.sendall(response[i:i + self.segment])
+
+    def close(self):
+        self.sock.close()
+
+
+def run(ota_module, size, repeat):
+    payload = os.urandom(size)
+    server = PayloadServer(payload)
+    ota = ota_module.WiFiOTA('ssid', 'password', '127.0.0.1', server.port)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dest_path = os.path.join(tmp, 'file.new')
+        targets = [
+            ('memory', {}),
+            ('file', {'dest_path': dest_path}),
+            ('firmware', {'firmware': True}),
+        ]
+        for name, kwargs in targets:
+            device_shim.stats.reset()
+            start = time.perf_counter()
+            # Discard the progress messages printed by the library
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(repeat):
+                    ota.get_data('file.bin', hash=True, **kwargs)
+            elapsed = time.perf_counter() - start
+            results.append((name, elapsed / repeat,
+                            size * repeat / elapsed / 1e6,
+                            device_shim.stats.recv_calls / repeat,
+                            device_shim.stats.connects))
+
+    ota.close()
+    server.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark WiFiOTA.get_data against a local server')
+    parser.add_argument('--lib', default=DEFAULT_LIB,
+                        help='directory containing OTA.py')
+    parser.add_argument('--sizes', default='1024,65536,1572864',
+                        help='comma separated payload sizes in bytes')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='downloads per payload size and target')
+    args = parser.parse_args()
+
+    ota_module = device_shim.load_ota(os.path.abspath(args.lib))
+
+    print("{:>10} {:>9} {:>12} {:>10} {:>12} {:>9}".format(
+          'size', 'target', 'ms/request', 'MB/s', 'recv/request',
+          'connects'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        for name, latency, throughput, recvs, connects in \
+                run(ota_module, size, args.repeat):
+            print("{:>10} {:>9} {:>12.3f} {:>10.2f} {:>12.1f} {:>9}".format(
+                  size, name, latency * 1000, throughput, recvs, connects))
+
+
+if __name__ == '__main__':
+    main()
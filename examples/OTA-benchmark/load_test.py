@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020, Pycom Limited.
+#
+# This software is licensed under the GNU GPL version 3 or any
+# later version, with permitted additional terms. For more information
+# see the Pycom Licence v1.0 document supplied with this file, or
+# available at https://www.pycom.io/opensource/licensing
+#
+
+# Load test for the WiFi OTA server (`OTA_server.py`).
+#
+# A synthetic server directory is generated in a temporary directory: a number
+# of consecutive versions, each with a configurable number of files of which a
+# fraction changes from one version to the next, and optionally a firmware
+# image per version. The OTA server is started on localhost in a separate
+# process and a number of simulated devices run the update download of the
+# WiFi OTA library (`WiFiOTA.get_data`, see `device_shim.py`) against it at
+# the same time:
+#    1. request the manifest from the oldest version
+#    2. download every new and updated file (compressed if available) and the
+#       firmware image (the delta if requested with --delta)
+#
+# Reported are the manifest latency percentiles, the download throughput and
+# the peak memory (RSS) of the server process.
+#
+# Usage:
+#    python3 load_test.py [--clients 50] [--rounds 2] [--versions 3]
+#                         [--files 40] [--file-size 4096] [--changed 0.25]
+#                         [--firmware-size 0] [--delta]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import device_shim
+
+OTA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'OTA')
+LIB_DIR = os.path.join(OTA_DIR, '1.0.1', 'flash', 'lib')
+
+WORDS = ['import', 'def', 'return', 'self', 'lora', 'socket', 'print', 'if',
+         'else', 'for', 'in', 'while', 'data', 'msg', 'value', 'time']
+
+
+def random_source(rnd, size):
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 10)))
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)[:size]
+
+
+# Creates the synthetic server directory in `path`
+def generate_tree(path, versions, files, file_size, changed, firmware_size):
+    rnd = random.Random(0)
+    sources = [random_source(rnd, file_size) for _ in range(files)]
+    firmware = bytearray(os.urandom(firmware_size))
+
+    names = ['1.0.{}'.format(i) for i in range(versions)]
+    for i, version in enumerate(names):
+        if i > 0:
+            for j in rnd.sample(range(files), int(files * changed)):
+                sources[j] = random_source(rnd, file_size)
+            for _ in range(8):
+                offset = rnd.randrange(max(len(firmware), 1))
+                firmware[offset:offset] = os.urandom(64)
+
+        lib = os.path.join(path, version, 'flash', 'lib')
+        os.makedirs(lib)
+        for j, source in enumerate(sources):
+            with open(os.path.join(lib, 'module_{}.py'.format(j)), 'w') as f:
+                f.write(source)
+        if firmware_size > 0:
+            name = 'firmware_{}.bin'.format(version)
+            with open(os.path.join(path, name), 'wb') as f:
+                f.write(firmware)
+    return names
+
+
+def start_server(path, port):
+    # The deltas are generated in the background, the server only accepts
+    # connections once they are all written
+    code = ("import sys, time; sys.path.insert(0, {!r})\n"
+            "import OTA_server as s\n"
+            "s.precompute_firmware_deltas()\n"
+            "while s._delta_jobs: time.sleep(0.1)\n"
+            "s.OTAServer(('127.0.0.1', {}), s.OTAHandler).serve_forever()"
+            .format(OTA_DIR, port))
+    proc = subprocess.Popen([sys.executable, '-B', '-W', 'ignore', '-c', code],
+                            cwd=path,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+    # Wait until the server accepts connections, delta generation can take a
+    # while with large firmware images
+    for _ in range(600):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise Exception("The OTA server failed to start")
+            time.sleep(0.1)
+    proc.kill()
+    raise Exception("The OTA server did not start")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# Statistics collected by all simulated devices
+class Results:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.manifest_latencies = []
+        self.bytes = 0
+        self.requests = 0
+        self.deltas = 0
+        self.errors = 0
+
+
+def run_device(ota_module, port, current_ver, device_id, rounds, delta,
+               results):
+    ota = ota_module.WiFiOTA('ssid', 'password', '127.0.0.1', port)
+    for _ in range(rounds):
+        try:
+            start = time.perf_counter()
+            req = 'manifest.json?current_ver={}&device_id={}'.format(
+                current_ver, device_id)
+            if delta:
+                req += '&delta=1'
+            manifest = json.loads(ota.get_data(req).decode())
+            latency = time.perf_counter() - start
+
+            downloads = []
+            deltas = 0
+            for f in manifest['new'] + manifest['update']:
+                downloads.append(f.get('compressed', f)['URL'])
+            if 'firmware' in manifest:
+                firmware = manifest['firmware']
+                if 'delta' in firmware:
+                    deltas += 1
+                downloads.append(firmware.get('delta', firmware)['URL'])
+
+            received = 0
+            for url in downloads:
+                received += len(ota.get_data(url.split("/", 3)[-1]))
+
+            with results.lock:
+                results.manifest_latencies.append(latency)
+                results.bytes += received
+                results.requests += len(downloads) + 1
+                results.deltas += deltas
+        except Exception as e:
+            with results.lock:
+                results.errors += 1
+            sys.stderr.write("Device {}: {}\n".format(device_id, e))
+        ota.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return float('nan')
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the WiFi OTA server with simulated devices')
+    parser.add_argument('--clients', type=int, default=50,
+                        help='number of concurrent devices')
+    parser.add_argument('--rounds', type=int, default=2,
+                        help='updates downloaded by every device')
+    parser.add_argument('--versions', type=int, default=3,
+                        help='number of versions on the server')
+    parser.add_argument('--files', type=int, default=40,
+                        help='number of files per version')
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help='size of each file in bytes')
+    parser.add_argument('--changed', type=float, default=0.25,
+                        help='fraction of files changed between versions')
+    parser.add_argument('--firmware-size', type=int, default=0,
+                        help='size of the firmware images, 0 for none')
+    parser.add_argument('--delta', action='store_true',
+                        help='request firmware deltas instead of full images')
+    args = parser.parse_args()
+
+    ota_module = device_shim.load_ota(LIB_DIR)
+
+    with tempfile.TemporaryDirectory() as path:
+        versions = generate_tree(path, args.versions, args.files,
+                                 args.file_size, args.changed,
+                                 args.firmware_size)
+        port = free_port()
+        server = start_server(path, port)
+
+        results = Results()
+        threads = [threading.Thread(target=run_device,
+                                    args=(ota_module, port, versions[0],
+                                          'device{}'.format(i), args.rounds,
+                                          args.delta, results))
+                   for i in range(args.clients)]
+
+        start = time.perf_counter()
+        # Discard the progress messages printed by the library
+        with contextlib.redirect_stdout(io.StringIO()):
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+        elapsed = time.perf_counter() - start
+
+        server.terminate()
+        server.wait()
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        max_rss //= 1024
+
+    latencies = [t * 1000 for t in results.manifest_latencies]
+    print("Devices:            {} x {} updates".format(args.clients,
+                                                     args.rounds))
+    print("Errors:             {}".format(results.errors))
+    if args.delta:
+        print("Firmware deltas:    {}".format(results.deltas))
+    print("Manifest latency:   p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, "
+          "max {:.1f} ms".format(percentile(latencies, 50),
+                                 percentile(latencies, 90),
+                                 percentile(latencies, 99),
+                                 max(latencies or [float('nan')])))
+    print("Requests:           {} ({:.0f} requests/s)".format(
+          results.requests, results.requests / elapsed))
+    print("Throughput:         {:.2f} MB in {:.2f} s ({:.2f} MB/s)".format(
+          results.bytes / 1e6, elapsed, results.bytes / 1e6 / elapsed))
+    print("Server peak RSS:    {:.1f} MB".format(max_rss / 1024))
+
+
+if __name__ == '__main__':
+    main()
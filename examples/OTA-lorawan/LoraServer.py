@@ -8,9 +8,13 @@
 # available at https://www.pycom.io/opensource/licensing
 #
 
-import urllib.request
+from urllib.parse import urlparse
+import http.client
 import binascii
 import base64
+import queue
+import copy
+import time
 import os
 import json
 import config
@@ -50,29 +54,115 @@ mcAddDevice_payload = {
     "multicastGroupID": "string"
 }
 
+class LoraServerError(Exception):
+
+    def __init__(self, status, body):
+        super().__init__("HTTP error {}: {}".format(status, body))
+        self.status = status
+
 class LoraServerClient:
 
+    # Maximum number of idle keep-alive connections kept to the API
+    POOL_SIZE = 4
+
+    # Number of attempts for a request failing with a connection error or a
+    # server error, waiting RETRY_BACKOFF * 2^n seconds between attempts
+    MAX_ATTEMPTS = 4
+    RETRY_BACKOFF = 0.5
+
+    TIMEOUT = 30
+
     def __init__(self):
         self.server = config.LORASERVER_URL
         self.port = config.LORASERVER_API_PORT
         self.email = config.LORASERVER_EMAIL
         self.passwd = config.LORASERVER_PASS
 
-    def login(self):
-        url = self.server + ':' + str(self.port) + '/api/internal/login'
-
-        login_payload["password"] = self.passwd
-        login_payload["email"] = self.email
+        self.host = urlparse(self.server).hostname
+        self.jwt = None
+        self._pool = queue.LifoQueue(maxsize=self.POOL_SIZE)
 
-        payload = bytes(json.dumps(login_payload),'utf-8')
+    def _get_connection(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.TIMEOUT)
 
+    def _release_connection(self, conn):
         try:
-            r = urllib.request.Request(url, data= payload, method= 'POST')
-            r.add_header("Content-Type", "application/json")
-            r.add_header("Accept", "application/json")
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _request(self, method, path, payload=None, jwt=None):
+        # Sends a request over a pooled keep-alive connection and returns the
+        # response body. Connection and server errors are retried with
+        # exponential backoff, an expired token is renewed once.
+        headers = {"Accept": "application/json"}
+        body = None
+        if payload is not None:
+            body = json.dumps(payload).encode('utf-8')
+            headers["Content-Type"] = "application/json"
+
+        renewed = False
+        attempt = 0
+        while True:
+            token = self.jwt or jwt
+            if token is not None:
+                headers["Grpc-Metadata-Authorization"] = "Bearer " + token
+
+            conn = self._get_connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                status = resp.status
+                data = resp.read().decode('utf-8')
+            except (http.client.HTTPException, OSError) as ex:
+                conn.close()
+                attempt += 1
+                if attempt >= self.MAX_ATTEMPTS:
+                    raise
+                print("Error requesting {} {}: {}, retrying".format(method, path, ex))
+                time.sleep(self.RETRY_BACKOFF * 2 ** (attempt - 1))
+                continue
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release_connection(conn)
+
+            if status == 401 and token is not None and not renewed:
+                renewed = True
+                if self.login() is not None:
+                    continue
+
+            if status >= 500 and attempt + 1 < self.MAX_ATTEMPTS:
+                attempt += 1
+                time.sleep(self.RETRY_BACKOFF * 2 ** (attempt - 1))
+                continue
+
+            if status >= 400:
+                raise LoraServerError(status, data)
+
+            return data
+
+    def login(self):
+        payload = copy.deepcopy(login_payload)
+        payload["password"] = self.passwd
+        payload["email"] = self.email
 
-            with urllib.request.urlopen(r) as f:
-                return json.loads(f.read().decode('utf-8'))['jwt']
+        try:
+            # Never send an expired token along with the login request
+            self.jwt = None
+            self.jwt = json.loads(self._request('POST', '/api/internal/login', payload))['jwt']
+            return self.jwt
 
         except Exception as ex:
             print("Error getting the jwt: {}".format(ex))
@@ -92,15 +182,9 @@ class LoraServerClient:
         return None
 
     def request_service_profile_id(self, profile_name, jwt):
-        url = self.server + ':' + str(self.port) + '/api/service-profiles?limit=100'
-
         try:
-            r = urllib.request.Request(url, method= 'GET')
-            r.add_header("Accept", "application/json")
-            r.add_header("Grpc-Metadata-Authorization", "Bearer " + jwt)
-
-            with urllib.request.urlopen(r) as f:
-                return self.parse_service_profile_list(f.read().decode('utf-8'), profile_name)
+            resp = self._request('GET', '/api/service-profiles?limit=100', jwt=jwt)
+            return self.parse_service_profile_list(resp, profile_name)
 
         except Exception as ex:
             print("Error getting service profile id: {}".format(ex))
@@ -114,33 +198,23 @@ class LoraServerClient:
         mcAppSKey = self.generate_random_key()
         mcNwkSKey = self.generate_random_key()
 
-        url = self.server + ':' + str(self.port) + '/api/multicast-groups'
-
-        mcGroup_payload["multicastGroup"]["dr"] = dr
-        mcGroup_payload["multicastGroup"]["frequency"] = freq
-        mcGroup_payload["multicastGroup"]["id"] = group_id.decode("utf-8")
-        mcGroup_payload["multicastGroup"]["mcAddr"] = mcAddr.decode("utf-8")
-        mcGroup_payload["multicastGroup"]["mcAppSKey"] = mcAppSKey.decode("utf-8")
-        mcGroup_payload["multicastGroup"]["mcNwkSKey"] = mcNwkSKey.decode("utf-8")
-        mcGroup_payload["multicastGroup"]["name"] = group_name
-        mcGroup_payload["multicastGroup"]["serviceProfileID"] = serviceProfileID
-
-        payload = bytes(json.dumps(mcGroup_payload),'utf-8')
-
+        payload = copy.deepcopy(mcGroup_payload)
+        payload["multicastGroup"]["dr"] = dr
+        payload["multicastGroup"]["frequency"] = freq
+        payload["multicastGroup"]["id"] = group_id.decode("utf-8")
+        payload["multicastGroup"]["mcAddr"] = mcAddr.decode("utf-8")
+        payload["multicastGroup"]["mcAppSKey"] = mcAppSKey.decode("utf-8")
+        payload["multicastGroup"]["mcNwkSKey"] = mcNwkSKey.decode("utf-8")
+        payload["multicastGroup"]["name"] = group_name
+        payload["multicastGroup"]["serviceProfileID"] = serviceProfileID
 
         try:
-            r = urllib.request.Request(url, data= payload, method= 'POST')
-            r.add_header("Content-Type", "application/json")
-            r.add_header("Accept", "application/json")
-            r.add_header("Grpc-Metadata-Authorization", "Bearer " + jwt)
-
-            with urllib.request.urlopen(r) as f:
-                resp = f.read().decode('utf-8')
-                if '"id":' in resp:
-                    multicast_id = json.loads(resp)["id"]
-                    return (multicast_id, mcAddr, mcNwkSKey, mcAppSKey)
-                else:
-                    return None
+            resp = self._request('POST', '/api/multicast-groups', payload, jwt)
+            if '"id":' in resp:
+                multicast_id = json.loads(resp)["id"]
+                return (multicast_id, mcAddr, mcNwkSKey, mcAppSKey)
+            else:
+                return None
         except Exception as ex:
             print("Error creating multicast data: {}".format(ex))
 
@@ -148,13 +222,9 @@ class LoraServerClient:
 
     def delete_multicast_group(self, group_id):
 
-        url = self.server + ':' + str(self.port) + '/api/multicast-groups/' + group_id
-
         try:
-            r = urllib.request.Request(url, method = 'DELETE')
-
-            with urllib.request.urlopen(r) as f:
-                return f.getcode() == 200
+            self._request('DELETE', '/api/multicast-groups/' + group_id)
+            return True
 
         except Exception as ex:
             print("Error deleting multicast group: {}".format(ex))
@@ -163,21 +233,13 @@ class LoraServerClient:
 
     def add_device_multicast_group(self, devEUI, group_id, jwt):
 
-        url = self.server + ':' + str(self.port) + '/api/multicast-groups/' + group_id + '/devices'
-
-        mcAddDevice_payload["devEUI"] = devEUI
-        mcAddDevice_payload["multicastGroupID"] = group_id
-
-        payload = json.dumps(mcAddDevice_payload).encode('utf-8')
+        payload = copy.deepcopy(mcAddDevice_payload)
+        payload["devEUI"] = devEUI
+        payload["multicastGroupID"] = group_id
 
         try:
-            r = urllib.request.Request(url, data= payload, method= 'POST')
-            r.add_header("Content-Type", "application/json")
-            r.add_header("Accept", "application/json")
-            r.add_header("Grpc-Metadata-Authorization", "Bearer " + jwt)
-
-            with urllib.request.urlopen(r) as f:
-                return f.getcode() == 200
+            self._request('POST', '/api/multicast-groups/' + group_id + '/devices', payload, jwt)
+            return True
 
         except Exception as ex:
             print("Error adding device to multicast group: {}".format(ex))
@@ -186,20 +248,13 @@ class LoraServerClient:
 
     def request_multicast_keys(self, group_id, jwt):
 
-        url = self.server + ':' + str(self.port) + '/api/multicast-groups/' + group_id
-
         try:
-            r = urllib.request.Request(url, method= 'GET')
-            r.add_header("Accept", "application/json")
-            r.add_header("Grpc-Metadata-Authorization", "Bearer " + jwt)
-
-            with urllib.request.urlopen(r) as f:
-                resp = f.read().decode('utf-8')
-                if "mcNwkSKey" in resp:
-                    json_resp = json.loads(resp)["multicastGroup"]
-                    return (json_resp["mcAddr"], json_resp["mcNwkSKey"], json_resp["mcAppSKey"])
-                else:
-                    return None
+            resp = self._request('GET', '/api/multicast-groups/' + group_id, jwt=jwt)
+            if "mcNwkSKey" in resp:
+                json_resp = json.loads(resp)["multicastGroup"]
+                return (json_resp["mcAddr"], json_resp["mcNwkSKey"], json_resp["mcAppSKey"])
+            else:
+                return None
         except Exception as ex:
             print("Error getting multicast keys: {}".format(ex))
 
@@ -216,22 +271,15 @@ class LoraServerClient:
             + b'-' + binascii.hexlify(os.urandom(2)) + b'-' + binascii.hexlify(os.urandom(6))
 
     def multicast_queue_length(self, jwt, multicast_group):
-        url = self.server + ':' + str(self.port) + '/api/multicast-groups/' + multicast_group + '/queue'
 
         try:
-            r = urllib.request.Request(url, method= 'GET')
-            r.add_header("Content-Type", "application/json")
-            r.add_header("Grpc-Metadata-Authorization", "Bearer " + jwt)
-
-            with urllib.request.urlopen(r) as f:
-                resp = f.read().decode('utf-8')
-                if "multicastQueueItems" in resp:
-                    print(resp)
-                    json_resp = json.loads(resp)["multicastQueueItems"]
-                    print("Len: {}".format(len(json_resp)))
-                    return len(json_resp)
-                else:
-                    return -1
+            resp = self._request('GET', '/api/multicast-groups/' + multicast_group + '/queue', jwt=jwt)
+            if "multicastQueueItems" in resp:
+                json_resp = json.loads(resp)["multicastQueueItems"]
+                print("Len: {}".format(len(json_resp)))
+                return len(json_resp)
+            else:
+                return -1
 
         except Exception as ex:
             print("Error getting multicast queue length: {}".format(ex))
@@ -239,24 +287,42 @@ class LoraServerClient:
         return -1
 
 
-    def send(self, jwt, multicast_group, data):
-        url = self.server + ':' + str(self.port) + '/api/multicast-groups/' + multicast_group + '/queue'
-
-        mcQueue_payload["multicastQueueItem"]["data"] = base64.b64encode(data).decode("utf-8")
-        mcQueue_payload["multicastQueueItem"]["multicastGroupID"] = multicast_group
-
-        payload = bytes(json.dumps(mcQueue_payload),'utf-8')
+    def multicast_fcnt(self, jwt, multicast_group):
 
         try:
-            r = urllib.request.Request(url, data= payload, method= 'POST')
-            r.add_header("Content-Type", "application/json")
-            r.add_header("Accept", "application/json")
-            r.add_header("Grpc-Metadata-Authorization", "Bearer " + jwt)
-
-            with urllib.request.urlopen(r) as f:
-                return f.getcode() == 200
+            resp = self._request('GET', '/api/multicast-groups/' + multicast_group, jwt=jwt)
+            return int(json.loads(resp)["multicastGroup"].get("fCnt", 0))
 
         except Exception as ex:
-            print("Error sending multicast data: {}".format(ex))
+            print("Error getting multicast frame counter: {}".format(ex))
 
-        return False
+        return -1
+
+    # Enqueues all items of `data_list` in order with consecutive frame
+    # counters starting at `fcnt` (read from the group if None). The network
+    # server schedules the Class C transmissions, so no pacing is done here.
+    # Returns the frame counter following the last item and the number of
+    # items enqueued, the frame counter is -1 if an item failed.
+    def send_batch(self, jwt, multicast_group, data_list, fcnt=None):
+
+        if fcnt is None:
+            fcnt = self.multicast_fcnt(jwt, multicast_group)
+            if fcnt < 0:
+                return -1, 0
+
+        path = '/api/multicast-groups/' + multicast_group + '/queue'
+        for sent, data in enumerate(data_list):
+            payload = copy.deepcopy(mcQueue_payload)
+            payload["multicastQueueItem"]["data"] = base64.b64encode(data).decode("utf-8")
+            payload["multicastQueueItem"]["fCnt"] = fcnt
+            payload["multicastQueueItem"]["multicastGroupID"] = multicast_group
+
+            try:
+                self._request('POST', path, payload, jwt)
+            except Exception as ex:
+                print("Error sending multicast data: {}".format(ex))
+                return -1, sent
+
+            fcnt += 1
+
+        return fcnt, len(data_list)
@@ -19,7 +19,30 @@ LORASERVER_PASS = 'admin'
 LORASERVER_SERVICE_PROFILE = 'ota_sp'
 LORASERVER_DOWNLINK_DR = 5
 LORASERVER_DOWNLINK_FREQ = 869525000
+LORASERVER_REGION = 'EU868'
 LORASERVER_APP_ID = 1 # Read from Web Interface / Applications
 
 #update configuration
 UPDATE_DELAY = 300
+FIRMWARE_POLL_INTERVAL = 5 # used when the watchdog package is not installed
+FIRMWARE_SETTLE_TIME = 2
+IO_WORKERS = 8 # threads for the LoRa Server REST and file system calls
+ENROLMENT_INTERVAL = 1 # seconds to collect devices before adding them to their multicast groups
+REGISTRY_DB = './ota_registry.db' # device and rollout state, kept across restarts
+REGISTRY_FLUSH_INTERVAL = 1 # seconds between writes of the registry changes
+FEC_REDUNDANCY = 0.2 # parity fragments per patch fragment (binary framing only)
+FEC_MIN_PARITY = 3
+DOWNLINK_DUTY_CYCLE = 0.1 # 10% in the EU868 869.4 - 869.65 MHz sub-band, 1.0 where no limit applies
+MULTICAST_QUEUE_DEPTH = 2 # downlinks kept in the network server queue during an update
+REPAIR_WINDOW = 60 # seconds to collect the lost fragment reports of the devices after an update
+REPAIR_ROUNDS = 2 # sessions resending lost fragments (binary framing only)
+
+#patch generation
+PATCH_CACHE_DIR = './patch_cache'
+DIFF_TIMEOUT = 5 # seconds spent on each diff, 0 for no limit
+PATCH_WORKERS = None # defaults to the number of CPUs
+
+#uplink processing
+UPLINK_WORKERS = 4
+UPLINK_QUEUE_SIZE = 4096 # uplinks waiting for a worker, further uplinks are dropped
+STATS_INTERVAL = 60 # seconds between pipeline statistics, 0 to disable
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020, Pycom Limited.
+#
+# This software is licensed under the GNU GPL version 3 or any
+# later version, with permitted additional terms. For more information
+# see the Pycom Licence v1.0 document supplied with this file, or
+# available at https://www.pycom.io/opensource/licensing
+#
+
+import threading
+import sqlite3
+import time
+
+# State of the devices and of the update cohorts (multicast groups), kept in
+# memory for constant time lookups and written to SQLite so a restart of the
+# updater service resumes the rollouts in progress. The changes are only
+# marked in memory, they are committed in one transaction by flush() which is
+# called periodically and never while the callers hold their own locks.
+class DeviceRegistry:
+
+    # Device update status
+    STATUS_IDLE = 'idle'
+    STATUS_PENDING = 'pending'
+    STATUS_ENROLLED = 'enrolled'
+    STATUS_SENT = 'sent'
+
+    # Cohort status
+    COHORT_PENDING = 'pending'
+    COHORT_UPDATING = 'updating'
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS devices ('
+                         'dev_eui TEXT PRIMARY KEY, version TEXT, cohort TEXT, '
+                         'last_seen INTEGER, status TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS devices_cohort ON devices (cohort)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cohorts ('
+                         'cohort TEXT PRIMARY KEY, group_id TEXT, mc_addr TEXT, '
+                         'mc_nwk_skey TEXT, mc_app_skey TEXT, session_id INTEGER, '
+                         'update_time INTEGER, status TEXT)')
+        self._db.commit()
+
+        self._devices = dict()
+        self._members = dict()
+        self._cohorts = dict()
+        self._dirty_devices = set()
+        self._dirty_cohorts = set()
+        self._load()
+
+    def _load(self):
+        for row in self._db.execute('SELECT cohort, group_id, mc_addr, mc_nwk_skey, mc_app_skey, '
+                                    'session_id, update_time, status FROM cohorts'):
+            self._cohorts[row[0]] = {
+                "group": (row[1], row[2].encode(), row[3].encode(), row[4].encode()),
+                "session_id": row[5],
+                "update_time": row[6],
+                "status": row[7]
+            }
+            self._members[row[0]] = set()
+
+        for row in self._db.execute('SELECT dev_eui, version, cohort, last_seen, status FROM devices'):
+            self._devices[row[0]] = {
+                "version": row[1],
+                "cohort": row[2],
+                "last_seen": row[3],
+                "status": row[4]
+            }
+            if row[2] is not None:
+                self._members.setdefault(row[2], set()).add(row[0])
+
+    def close(self):
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    # Writes the changes made since the last flush
+    def flush(self):
+        with self._lock:
+            devices = [(dev_eui, self._devices[dev_eui]["version"], self._devices[dev_eui]["cohort"],
+                        self._devices[dev_eui]["last_seen"], self._devices[dev_eui]["status"])
+                       for dev_eui in self._dirty_devices]
+            cohorts = []
+            removed = []
+            for cohort in self._dirty_cohorts:
+                record = self._cohorts.get(cohort)
+                if record is None:
+                    removed.append((cohort,))
+                    continue
+                group = record["group"]
+                cohorts.append((cohort, group[0], group[1].decode(), group[2].decode(), group[3].decode(),
+                                record["session_id"], record["update_time"], record["status"]))
+            self._dirty_devices = set()
+            self._dirty_cohorts = set()
+
+        if len(devices) == 0 and len(cohorts) == 0 and len(removed) == 0:
+            return
+
+        with self._db_lock:
+            self._db.executemany('DELETE FROM cohorts WHERE cohort = ?', removed)
+            self._db.executemany('INSERT OR REPLACE INTO cohorts VALUES (?, ?, ?, ?, ?, ?, ?, ?)', cohorts)
+            self._db.executemany('INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?)', devices)
+            self._db.commit()
+
+    def get_device(self, dev_eui):
+        with self._lock:
+            device = self._devices.get(dev_eui)
+            return dict(device) if device is not None else None
+
+    def device_cohort(self, dev_eui):
+        with self._lock:
+            device = self._devices.get(dev_eui)
+            return device["cohort"] if device is not None else None
+
+    # Records an uplink of a device, optionally moving it to `cohort`
+    def update_device(self, dev_eui, version, cohort=None, status=None):
+        with self._lock:
+            device = self._devices.get(dev_eui)
+            if device is None:
+                device = {"version": version, "cohort": None, "last_seen": 0, "status": self.STATUS_IDLE}
+                self._devices[dev_eui] = device
+
+            if cohort is not None and cohort != device["cohort"]:
+                if device["cohort"] in self._members:
+                    self._members[device["cohort"]].discard(dev_eui)
+                self._members.setdefault(cohort, set()).add(dev_eui)
+                device["cohort"] = cohort
+
+            device["version"] = version
+            device["last_seen"] = int(time.time())
+            if status is not None:
+                device["status"] = status
+            self._dirty_devices.add(dev_eui)
+
+    def set_device_status(self, dev_eui, status):
+        with self._lock:
+            if dev_eui not in self._devices:
+                return
+            self._devices[dev_eui]["status"] = status
+            self._dirty_devices.add(dev_eui)
+
+    # Returns (devEUI, cohort) of all devices with `status`
+    def devices_with_status(self, status):
+        with self._lock:
+            return [(dev_eui, device["cohort"]) for dev_eui, device in self._devices.items() if device["status"] == status]
+
+    def cohorts(self):
+        with self._lock:
+            return list(self._cohorts)
+
+    def get_cohort(self, cohort):
+        with self._lock:
+            record = self._cohorts.get(cohort)
+            return dict(record) if record is not None else None
+
+    def cohort_members(self, cohort):
+        with self._lock:
+            return set(self._members.get(cohort, ()))
+
+    def add_cohort(self, cohort, multicast_param, session_id, update_time):
+        group = (multicast_param[0], multicast_param[1], multicast_param[2], multicast_param[3])
+        with self._lock:
+            self._cohorts[cohort] = {
+                "group": group,
+                "session_id": session_id,
+                "update_time": update_time,
+                "status": self.COHORT_PENDING
+            }
+            self._members.setdefault(cohort, set())
+            self._dirty_cohorts.add(cohort)
+
+    def set_cohort_status(self, cohort, status):
+        with self._lock:
+            if cohort not in self._cohorts:
+                return
+            self._cohorts[cohort]["status"] = status
+            self._dirty_cohorts.add(cohort)
+
+    # Removes a finished cohort, its members keep their record with `status`
+    def remove_cohort(self, cohort, status):
+        with self._lock:
+            self._cohorts.pop(cohort, None)
+            self._dirty_cohorts.add(cohort)
+            for dev_eui in self._members.pop(cohort, ()):
+                device = self._devices[dev_eui]
+                device["cohort"] = None
+                device["status"] = status
+                self._dirty_devices.add(dev_eui)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020, Pycom Limited.
+#
+# This software is licensed under the GNU GPL version 3 or any
+# later version, with permitted additional terms. For more information
+# see the Pycom Licence v1.0 document supplied with this file, or
+# available at https://www.pycom.io/opensource/licensing
+#
+
+# Forward error correction of the multicast patch fragments, using the parity
+# coding of the LoRaWAN Fragmented Data Block Transport specification (TS004).
+# Parity fragment n (starting at 1) of a block of m fragments is the XOR of the
+# fragments selected by matrix_line(n, m), the shorter last fragment being
+# padded with zeros. Any m received fragments, uncoded or parity, are usually
+# enough to rebuild the block.
+#
+# This module is shared by the update server and the devices and must run on
+# both CPython and MicroPython.
+
+def prbs23(x):
+    b0 = x & 1
+    b1 = (x & 32) >> 5
+    return (x >> 1) + ((b0 ^ b1) << 22)
+
+def matrix_line(n, m):
+    line = bytearray(m)
+
+    # A single fragment is simply repeated
+    if m < 2:
+        for i in range(m):
+            line[i] = 1
+        return line
+
+    mm = 1 if (m & (m - 1)) == 0 else 0
+    x = 1 + 1001 * n
+    for i in range(m // 2):
+        r = 1 << 16
+        while r >= m:
+            x = prbs23(x)
+            r = x % (m + mm)
+        line[r] = 1
+
+    return line
+
+def xor_into(dst, src):
+    for i in range(len(src)):
+        dst[i] ^= src[i]
+
+def parity_fragment(fragments, n, size):
+    line = matrix_line(n, len(fragments))
+    parity = bytearray(size)
+    for i in range(len(fragments)):
+        if line[i]:
+            xor_into(parity, fragments[i])
+
+    return parity
+
+# Bitmap of fragment indices, fragment i is bit i % 8 of byte i // 8. Used by
+# the devices to report lost fragments.
+def fragment_bitmap(indices, count):
+    bitmap = bytearray((count + 7) // 8)
+    for i in indices:
+        bitmap[i // 8] |= 1 << (i % 8)
+
+    return bitmap
+
+def bitmap_fragments(bitmap, count):
+    count = min(count, len(bitmap) * 8)
+    return [i for i in range(count) if bitmap[i // 8] & (1 << (i % 8))]
+
+class FragmentDecoder:
+
+    def __init__(self, store=None):
+        self.reset(store)
+
+    # The fragments are kept in `store`, a dict unless given, e.g. a spool on
+    # flash on the devices
+    def reset(self, store=None):
+        self.fragments = store if store is not None else dict()
+        self.parity = []
+        self.count = None
+
+    def add_fragment(self, index, data):
+        self.fragments[index] = bytes(data)
+
+    def set_count(self, count):
+        self.count = count
+
+    def add_parity(self, n, count, data):
+        self.count = count
+        self.parity.append((n, bytes(data)))
+
+    def fragment_count(self):
+        if self.count is not None:
+            return self.count
+        if len(self.fragments) > 0:
+            return max(self.fragments) + 1
+        return 0
+
+    def missing(self):
+        return [i for i in range(self.fragment_count()) if i not in self.fragments]
+
+    def missing_bitmap(self):
+        return fragment_bitmap(self.missing(), self.fragment_count())
+
+    # Rebuilds the lost fragments in the store, returns False if some of them
+    # could not be recovered
+    def recover(self):
+        missing = self.missing()
+        return len(missing) == 0 or self._recover(missing)
+
+    # Returns the reassembled block or None if lost fragments could not be
+    # recovered
+    def decode(self):
+        if not self.recover():
+            return None
+
+        return b''.join([self.fragments[i] for i in range(self.fragment_count())])
+
+    def _recover(self, missing):
+        if len(self.parity) < len(missing):
+            return False
+
+        count = self.fragment_count()
+        bits = dict()
+        for bit, i in enumerate(missing):
+            bits[i] = bit
+
+        # Remove the received fragments from the parity equations, leaving a
+        # bitmask of the missing fragments in each of them
+        rows = []
+        for n, data in self.parity:
+            line = matrix_line(n, count)
+            mask = 0
+            acc = bytearray(data)
+            for i in range(count):
+                if line[i]:
+                    if i in bits:
+                        mask |= 1 << bits[i]
+                    else:
+                        xor_into(acc, self.fragments[i])
+            if mask:
+                rows.append([mask, acc])
+
+        # Gauss-Jordan elimination over GF(2)
+        for bit in range(len(missing)):
+            flag = 1 << bit
+            pivot = None
+            for r in range(bit, len(rows)):
+                if rows[r][0] & flag:
+                    pivot = r
+                    break
+            if pivot is None:
+                return False
+
+            rows[bit], rows[pivot] = rows[pivot], rows[bit]
+            for r in range(len(rows)):
+                if r != bit and rows[r][0] & flag:
+                    rows[r][0] ^= rows[bit][0]
+                    xor_into(rows[r][1], rows[bit][1])
+
+        for bit, i in enumerate(missing):
+            data = bytes(rows[bit][1])
+            # Recovered fragments are zero padded
+            if i == count - 1:
+                data = data.rstrip(b'\x00')
+            self.fragments[i] = data
+
+        return True
@@ -9,6 +9,7 @@
 #
 
 from network import LoRa
+from ucollections import deque
 import socket
 import binascii
 import struct
@@ -16,6 +17,13 @@ import time
 import _thread
 
 class LoraNet:
+
+    # Received packets waiting for the consumer thread, and application
+    # messages waiting for receive()
+    RX_SLOTS = 16
+    RX_SLOT_SIZE = 256
+    APP_QUEUE_SIZE = 16
+
     def __init__(self, frequency, dr, region, device_class=LoRa.CLASS_C, activation = LoRa.OTAA, auth = None):
         self.frequency = frequency
         self.dr = dr
@@ -28,28 +36,80 @@ class LoraNet:
         self.s_lock = _thread.allocate_lock()
         self.lora = LoRa(mode=LoRa.LORAWAN, region = self.region, device_class = self.device_class)
 
-        self._msg_queue = []
-        self.q_lock = _thread.allocate_lock()
+        # Ring buffer filled by the receive callback and emptied by the
+        # consumer thread. Each index is only written by one side.
+        self._rx_slots = [bytearray(self.RX_SLOT_SIZE) for i in range(self.RX_SLOTS)]
+        self._rx_sizes = [0] * self.RX_SLOTS
+        self._rx_head = 0
+        self._rx_tail = 0
+        self.rx_dropped = 0
+        self._rx_signal = _thread.allocate_lock()
+        self._rx_signal.acquire()
+
+        self._msg_queue = deque((), self.APP_QUEUE_SIZE)
         self._process_ota_msg = None
 
+        # Session id of the binary framed OTA update, set by LoraOTA
+        self.ota_session = None
+
     def stop(self):
         self._exit = True
+        self._wake_consumer()
 
     def init(self, process_msg_callback):
         self._process_ota_msg = process_msg_callback
+        _thread.start_new_thread(self._consumer_proc, ())
 
+    # Runs in the interrupt context, only copies the packet to the ring buffer
     def receive_callback(self, lora):
         events = lora.events()
         if events & LoRa.RX_PACKET_EVENT:
-            rx, port = self.sock.recvfrom(256)
+            rx, port = self.sock.recvfrom(self.RX_SLOT_SIZE)
             if rx:
-                if '$OTA' in rx:
-                    print("OTA msg received: {}".format(rx))
-                    self._process_ota_msg(rx.decode())
-                else:
-                    self.q_lock.acquire()
-                    self._msg_queue.append(rx)
-                    self.q_lock.release()
+                head = self._rx_head
+                next_head = (head + 1) % self.RX_SLOTS
+                if next_head == self._rx_tail:
+                    self.rx_dropped += 1
+                    return
+
+                self._rx_slots[head][:len(rx)] = rx
+                self._rx_sizes[head] = len(rx)
+                self._rx_head = next_head
+                self._wake_consumer()
+
+    def _wake_consumer(self):
+        try:
+            if self._rx_signal.locked():
+                self._rx_signal.release()
+        except RuntimeError:
+            pass
+
+    def _consumer_proc(self):
+        while not self._exit:
+            self._rx_signal.acquire()
+
+            while self._rx_tail != self._rx_head:
+                tail = self._rx_tail
+                rx = bytes(self._rx_slots[tail][:self._rx_sizes[tail]])
+                self._rx_tail = (tail + 1) % self.RX_SLOTS
+
+                # A malformed message must not stop the only consumer thread
+                try:
+                    if self._is_ota_msg(rx):
+                        print("OTA msg received: {}".format(rx))
+                        self._process_ota_msg(rx)
+                    else:
+                        # The oldest message is dropped when the queue is full
+                        self._msg_queue.append(rx)
+                except Exception as ex:
+                    print("Exception processing received message: {}".format(ex))
+
+    def _is_ota_msg(self, rx):
+        # Binary frames are only accepted for the negotiated update session
+        if rx[0] & 0x80:
+            return self.ota_session is not None and len(rx) > 1 and rx[1] == self.ota_session
+
+        return b'$OTA' in rx
 
     def connect(self):
         if self.activation != LoRa.OTAA and self.activation != LoRa.ABP:
@@ -119,10 +179,10 @@ class LoraNet:
             self.sock.send(packet)
 
     def receive(self, bufsize):
-        with self.q_lock:
-            if len(self._msg_queue) > 0:
-                return self._msg_queue.pop(0)
-        return ''
+        try:
+            return self._msg_queue.popleft()
+        except IndexError:
+            return ''
 
     def get_dev_eui(self):
         return binascii.hexlify(self.lora.mac()).decode('ascii')
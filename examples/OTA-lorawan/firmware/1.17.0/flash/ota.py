@@ -9,10 +9,13 @@
 #
 
 import diff_match_patch as dmp_module
+from fec import FragmentDecoder
+from patcher import PatchApplier
+from spool import PatchSpool
 from watchdog import Watchdog
 from machine import RTC
+from machine import Timer
 import ubinascii
-import uhashlib
 import _thread
 import utime
 import uos
@@ -43,6 +46,21 @@ class LoraOTA:
 
     DELETE_FILE_MSG = 10
     MANIFEST_MSG = 11
+    UPDATE_TYPE_PARITY = 12
+
+    MISSING_FRAGMENTS_MSG = 13
+    MISSING_FRAGMENTS_REPLY = 14
+
+    # Binary framing of the multicast update messages, negotiated in the
+    # UPDATE_INFO exchange: <0x80 | type> <session id> <index (2 bytes)> <data>
+    BINARY_FRAMING = b'B'
+    FRAME_FLAG = 0x80
+    FRAME_HEADER_SIZE = 4
+    CHECKSUM_SIZE = 20
+
+    # Patch fragment sizes, as sent by the server
+    ASCII_FRAGMENT_SIZE = 200
+    BINARY_FRAGMENT_SIZE = 203
 
     def __init__(self, lora):
         self.lora = lora
@@ -62,23 +80,72 @@ class LoraOTA:
         self.mcNwkSKey = None
         self.mcAppSKey = None
 
-        self.patch = ''
+        # The patch of the file being received is spooled to flash, the
+        # verified patches are applied from their spool files
+        self.spool = None
+        self.spool_count = 0
+        self.decoder = FragmentDecoder()
+        self.session_id = None
+        self.file_idx = None
         self.file_to_patch = None
         self.patch_list = dict()
         self.checksum_failure = False
         self.device_mainfest = None
 
-        self._exit = False
-        _thread.start_new_thread(self._thread_proc, ())
+        # Files whose lost fragments could not be rebuilt, by file index, kept
+        # until the server sends the missing fragments again
+        self.incomplete = dict()
+        self.repair_pending = False
+        self.awaiting_repair = False
+        self.repair_rounds = 0
+        self.max_repair_rounds = 2
+
+        # The update thread blocks on this lock until a reply it waits for is
+        # received, the watchdog fails or its next check is due
+        self._signal = _thread.allocate_lock()
+        self._signal.acquire()
+        self._expected_reply = None
 
         self.inactivity_timeout = 120
-        self.wdt = Watchdog()
+        self.wdt = Watchdog(self.wakeup)
+
+        self._exit = False
+        _thread.start_new_thread(self._thread_proc, ())
 
         self.lora.init(self.process_message)
 
     def stop(self):
         self.lora.stop()
         self._exit = True
+        self.wakeup()
+
+    # Wakes the update thread, called from the receive path and from timers
+    def wakeup(self, *args):
+        try:
+            if self._signal.locked():
+                self._signal.release()
+        except RuntimeError:
+            pass
+
+    # Blocks the update thread until woken or `timeout` seconds elapse, the
+    # CPU idles meanwhile. Callers check their condition again afterwards.
+    def _wait(self, timeout):
+        ms = int(timeout * 1000)
+        if ms <= 0:
+            return
+
+        alarm = Timer.Alarm(self.wakeup, ms=ms)
+        self._signal.acquire()
+        alarm.cancel()
+
+    # Seconds until the next periodic check of the update thread
+    def _next_check(self, updates_check_time):
+        now = utime.time()
+        if self.update_time > 0 and not self.update_in_progress:
+            return self.update_time - self.listen_before_sec - now
+        if self.update_time < 0:
+            return updates_check_time - now
+        return self.updates_check_period
 
     def _thread_proc(self):
         updates_check_time = utime.time()
@@ -86,7 +153,7 @@ class LoraOTA:
 
         while not self._exit:
             if utime.time() > updates_check_time and self.update_time < 0:
-                self.synch_request(self.check_firmware_updates)
+                self.synch_request(self.check_firmware_updates, self.UPDATE_INFO_REPLY)
                 updates_check_time = utime.time() + self.updates_check_period
 
             if self.update_time > 0 and not self.update_in_progress:
@@ -94,14 +161,20 @@ class LoraOTA:
                     self.update_in_progress = True
                     self.updating_proc()
 
+            if self.repair_pending:
+                self.repair_pending = False
+                self.request_repair()
+
             if self.update_failed():
                 print('Update failed: No data received')
                 machine.reset()
 
-            utime.sleep(2)
+            self._wait(max(1, self._next_check(updates_check_time)))
 
     def updating_proc(self):
-        self.synch_request(self.get_mulitcast_keys)
+        # Spools left by an interrupted update
+        LoraOTA.remove_spools()
+        self.synch_request(self.get_mulitcast_keys, self.MULTICAST_KEY_REPLY)
 
         if self.mcAddr is not None:
             mulitcast_auth = (self.mcAddr, self.mcNwkSKey, self.mcAppSKey)
@@ -110,7 +183,7 @@ class LoraOTA:
             wdt_timeout = self.listen_before_sec + self.inactivity_timeout
             self.wdt.enable(wdt_timeout)
 
-            self.synch_request(self.send_listening_msg)
+            self.synch_request(self.send_listening_msg, self.LISTENING_REPLY)
         else:
             self.reset_update_params()
 
@@ -131,6 +204,19 @@ class LoraOTA:
         self.update_in_progress = False
         self.update_time = -1
         self.update_version = '0.0.0'
+        self.session_id = None
+        self.lora.ota_session = None
+
+        for filename, decoder, spool in self.incomplete.values():
+            spool.close()
+        self.incomplete = dict()
+        self.repair_pending = False
+        self.awaiting_repair = False
+        self.repair_rounds = 0
+
+        self.close_spool()
+        self.patch_list = dict()
+        LoraOTA.remove_spools()
 
     def get_mulitcast_keys(self):
         msg = bytearray()
@@ -140,20 +226,31 @@ class LoraOTA:
 
         self.lora.send(msg)
 
-    def synch_request(self, func):
+    def synch_request(self, func, reply_type):
         attempt_num = 0
         self.resp_received = False
+        self._expected_reply = reply_type
 
         while attempt_num < self.max_send and not self.resp_received:
             func()
 
-            count_10ms = 0
-            while(count_10ms <= self.operation_timeout * 100 and not self.resp_received):
-                count_10ms += 1
-                utime.sleep(0.01)
+            deadline = utime.ticks_add(utime.ticks_ms(), self.operation_timeout * 1000)
+            while not self.resp_received:
+                remaining = utime.ticks_diff(deadline, utime.ticks_ms())
+                if remaining <= 0:
+                    break
+                self._wait(remaining / 1000)
 
             attempt_num += 1
 
+        self._expected_reply = None
+
+    # Called by the receive path once a reply has been processed
+    def response_received(self, reply_type):
+        if reply_type == self._expected_reply:
+            self.resp_received = True
+            self.wakeup()
+
     def check_firmware_updates(self):
         msg = bytearray()
         msg.extend(self.MSG_HEADER)
@@ -161,6 +258,7 @@ class LoraOTA:
 
         version = self.get_current_version().encode()
         msg.extend(b',' + version)
+        msg.extend(b',' + self.BINARY_FRAMING)
         msg.extend(b',' + self.MSG_TAIL)
 
         self.lora.send(msg)
@@ -186,6 +284,29 @@ class LoraOTA:
 
         self.lora.send(msg)
 
+    def send_missing_fragments_msg(self, file_idx, decoder):
+        msg = bytearray()
+        msg.extend(self.MSG_HEADER)
+        msg.extend(b',' + str(self.MISSING_FRAGMENTS_MSG).encode())
+        msg.extend(b',' + str(self.session_id).encode())
+        msg.extend(b',' + str(file_idx).encode())
+        msg.extend(b',' + str(decoder.fragment_count()).encode())
+        msg.extend(b',' + ubinascii.hexlify(decoder.missing_bitmap()))
+        msg.extend(b',' + self.MSG_TAIL)
+
+        self.lora.send(msg)
+
+    def request_repair(self):
+        # The repair session may already start while requesting
+        for file_idx, (filename, decoder, spool) in list(self.incomplete.items()):
+            self.synch_request(lambda: self.send_missing_fragments_msg(file_idx, decoder), self.MISSING_FRAGMENTS_REPLY)
+            if not self.resp_received:
+                print('No repair session: Discarding update ...')
+                self.reset_update_params()
+                return
+
+        self.wdt.enable(self.inactivity_timeout)
+
     def _write_version_info(self, version):
         try:
             with open(self.version_file, 'w+') as fh:
@@ -222,7 +343,6 @@ class LoraOTA:
         return True
 
     def parse_update_info_reply(self, msg):
-        self.resp_received = True
 
         try:
             token_msg = msg.split(",")
@@ -234,10 +354,19 @@ class LoraOTA:
             if utime.time() < 1550000000:
                 self.sync_clock(int(token_msg[5]))
 
+            # The session id is only present if the server uses the binary
+            # framing for this update
+            self.session_id = None
+            if len(token_msg) > 7 and len(token_msg[6]) > 0:
+                self.session_id = int(token_msg[6])
+            self.lora.ota_session = self.session_id
+
         except Exception as ex:
             print("Exception getting update information: {}".format(ex))
+            self.response_received(self.UPDATE_INFO_REPLY)
             return False
 
+        self.response_received(self.UPDATE_INFO_REPLY)
         return True
 
     def parse_multicast_keys(self, msg):
@@ -253,7 +382,7 @@ class LoraOTA:
 
             print("mcAddr: {}, mcNwkSKey: {}, mcAppSKey: {}".format(self.mcAddr, self.mcNwkSKey, self.mcAppSKey))
 
-            self.resp_received = True
+            self.response_received(self.MULTICAST_KEY_REPLY)
         except Exception as ex:
             print("Exception getting multicast keys: {}".format(ex))
             return False
@@ -261,7 +390,10 @@ class LoraOTA:
         return True
 
     def parse_listening_reply(self, msg):
-        self.resp_received = True
+        self.response_received(self.LISTENING_REPLY)
+
+    def parse_missing_fragments_reply(self, msg):
+        self.response_received(self.MISSING_FRAGMENTS_REPLY)
 
     def _data_start_idx(self, msg):
         # Find first index
@@ -283,16 +415,12 @@ class LoraOTA:
             print("Exception getting msg data: {}".format(ex))
         return data
 
-    def process_patch_msg(self, msg):
-        partial_patch = self.get_msg_data(msg)
+    def process_patch_msg(self, partial_patch):
+        if partial_patch and self.spool is not None:
+            self.spool.append(partial_patch.encode())
 
-        if partial_patch:
-            self.patch += partial_patch
-
-    def verify_patch(self, patch, received_checksum):
-        h = uhashlib.sha1()
-        h.update(patch)
-        checksum = ubinascii.hexlify(h.digest()).decode()
+    def verify_patch(self, spool, received_checksum):
+        checksum = spool.hexdigest(self.decoder.fragment_count())
         print("Computed checksum: {}".format(checksum))
         print("Received checksum: {}".format(received_checksum))
 
@@ -302,14 +430,41 @@ class LoraOTA:
 
         return True
 
-    def process_checksum_msg(self, msg):
-        checksum = self.get_msg_data(msg)
-        verified = self.verify_patch(self.patch, checksum)
+    def process_checksum_msg(self, checksum):
+        if self.spool is None:
+            return
+
+        verified = self.verify_patch(self.spool, checksum)
+        self.spool.close()
         if verified:
-            self.patch_list[self.file_to_patch] = self.patch
+            self.patch_list[self.file_to_patch] = self.spool.path
+        else:
+            uos.remove(self.spool.path)
 
         self.file_to_patch = None
-        self.patch = ''
+        self.spool = None
+        self.decoder.reset()
+
+    def open_spool(self):
+        self.close_spool()
+
+        if self.session_id is not None:
+            slot_size = self.BINARY_FRAGMENT_SIZE
+        else:
+            slot_size = self.ASCII_FRAGMENT_SIZE
+        self.spool_count += 1
+        self.spool = PatchSpool('/flash/ota_{}.spool'.format(self.spool_count), slot_size)
+
+    def close_spool(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    @staticmethod
+    def remove_spools():
+        for file in uos.listdir('/flash'):
+            if file.endswith('.spool'):
+                uos.remove('/flash/' + file)
 
     def backup_file(self, filename):
         bak_path = "{}.bak".format(filename)
@@ -323,9 +478,7 @@ class LoraOTA:
         # Backup current file
         uos.rename(filename, bak_path)
 
-    def process_delete_msg(self, msg):
-        filename = self.get_msg_data(msg)
-
+    def process_delete_msg(self, filename):
         if self.file_exists('/flash/' + filename):
             self.backup_file('/flash/' + filename)
             self.device_mainfest["delete"] += 1
@@ -337,7 +490,7 @@ class LoraOTA:
     def _read_file(self, filename):
 
         try:
-            with open('/flash/' + filename, 'r') as fh:
+            with open(filename, 'r') as fh:
                 return fh.read()
         except Exception as ex:
             print("Error reading file: {}".format(ex))
@@ -366,24 +519,41 @@ class LoraOTA:
             print("Error writing to file: {}".format(ex))
             return False
 
+        self._replace_file(filename, tmp_file)
+
+        return True
+
+    def _replace_file(self, filename, tmp_file):
         if self.file_exists('/flash/' + filename):
             self.backup_file('/flash/' + filename)
         uos.rename(tmp_file, '/flash/' + filename)
 
-        return True
-
+    # The patched files are written while streaming the old file and the patch
+    # from flash, only when the old file differs from the one the patch was
+    # made from is it loaded for the fuzzy matching of diff_match_patch
     def apply_patches(self):
-        for key, value in self.patch_list.items():
-            self.dmp = dmp_module.diff_match_patch()
-            self.patch_list = self.dmp.patch_fromText(value)
+        self.dmp = dmp_module.diff_match_patch()
+        applier = PatchApplier(self.dmp)
 
-            to_patch = ''
+        for key, value in self.patch_list.items():
+            src_file = None
             print('Updating file: {}'.format(key))
             if self.update_type == self.DIFF_UPDATE and \
                self.file_exists('/flash/' + key):
-                to_patch = self._read_file(key)
+                src_file = '/flash/' + key
+
+            tmp_file = self.get_tmp_filename('/flash/' + key)
+            if applier.apply(value, src_file, tmp_file):
+                self._replace_file(key, tmp_file)
+                continue
+
+            to_patch = ''
+            if src_file is not None:
+                to_patch = self._read_file(src_file)
 
-            patched_text, success = self.dmp.patch_apply(self.patch_list, to_patch)
+            patches = self.dmp.patch_fromText(self._read_file(value))
+            patched_text, success = self.dmp.patch_apply(patches, to_patch)
+            patches = None
             if False in success:
                 return False
 
@@ -416,7 +586,7 @@ class LoraOTA:
             start_idx = msg.find("{")
             stop_idx = msg.find("}")
 
-            recv_manifest = json.loads(msg[start_idx:stop_idx])
+            recv_manifest = json.loads(msg[start_idx:stop_idx + 1])
 
             print("Received manifest: {}".format(recv_manifest))
             print("Actual manifest: {}".format(self.device_mainfest))
@@ -431,23 +601,51 @@ class LoraOTA:
 
         return False
 
-    def process_manifest_msg(self, msg):
+    def process_manifest_msg(self, manifest):
+        if self.spool is not None:
+            # The checksum of the last file was lost
+            if self.session_id is not None:
+                self.keep_incomplete()
+            else:
+                self.checksum_failure = True
+                self.close_spool()
 
-        if self.manifest_failure(msg):
+        if self.manifest_failure(manifest):
             print('Manifest failure: Discarding update ...')
             self.reset_update_params()
-        if self.checksum_failure:
+        elif self.checksum_failure:
             print('Failed checksum: Discarding update ...')
             self.reset_update_params()
+        elif len(self.incomplete) > 0:
+            # The manifest is sent several times, the repair is only requested
+            # once per round
+            if self.awaiting_repair:
+                return
+            if self.repair_rounds >= self.max_repair_rounds:
+                print('Lost fragments: Discarding update ...')
+                self.reset_update_params()
+            else:
+                self.repair_rounds += 1
+                self.awaiting_repair = True
+                self.repair_pending = True
+                self.wakeup()
         elif not self.apply_patches():
             LoraOTA.revert()
         else:
             print('Update Success: Restarting .... ')
+            LoraOTA.remove_spools()
             self._write_version_info(self.update_version)
             machine.reset()
 
-    def process_filename_msg(self, msg):
-        self.file_to_patch = self.get_msg_data(msg)
+    def process_filename_msg(self, filename):
+        if self.spool is not None:
+            # The checksum of the previous file was lost, without the binary
+            # framing it can not be repaired
+            self.checksum_failure = True
+
+        self.file_to_patch = filename
+        self.open_spool()
+        self.decoder.reset(self.spool)
 
         if self.update_type == self.DIFF_UPDATE and \
            self.file_exists('/flash/' + self.file_to_patch):
@@ -462,9 +660,86 @@ class LoraOTA:
     def update_failed(self):
         return self.wdt.update_failed()
 
+    def process_update_msg(self, msg_type, data):
+        if msg_type == self.UPDATE_TYPE_FNAME:
+            self.process_filename_msg(data)
+        elif msg_type == self.UPDATE_TYPE_PATCH:
+            self.process_patch_msg(data)
+        elif msg_type == self.UPDATE_TYPE_CHECKSUM:
+            self.process_checksum_msg(data)
+        elif msg_type == self.DELETE_FILE_MSG:
+            self.process_delete_msg(data)
+        elif msg_type == self.MANIFEST_MSG:
+            self.process_manifest_msg(data)
+
+    # Keeps the file being received until its lost fragments are sent again
+    def keep_incomplete(self):
+        self.incomplete[self.file_idx] = (self.file_to_patch, self.decoder, self.spool)
+        self.decoder = FragmentDecoder()
+        self.file_to_patch = None
+        self.spool = None
+
+    def process_frame(self, frame):
+        if len(frame) < self.FRAME_HEADER_SIZE or frame[1] != self.session_id:
+            return
+
+        msg_type = frame[0] & ~self.FRAME_FLAG
+        index = (frame[2] << 8) | frame[3]
+        payload = bytes(frame[self.FRAME_HEADER_SIZE:])
+
+        if msg_type == self.UPDATE_TYPE_FNAME:
+            if self.spool is not None:
+                # The checksum of the previous file was lost, its fragments
+                # are requested again
+                self.keep_incomplete()
+            self.file_idx = index
+
+        # Repair sessions send again the files lost by any of the devices, only
+        # the ones still incomplete here are received, the others already
+        # passed their checksum
+        if self.repair_rounds > 0 and msg_type in (self.UPDATE_TYPE_FNAME, self.UPDATE_TYPE_PATCH,
+                                                   self.UPDATE_TYPE_PARITY, self.UPDATE_TYPE_CHECKSUM):
+            if msg_type == self.UPDATE_TYPE_FNAME:
+                if index in self.incomplete:
+                    self.file_to_patch, self.decoder, self.spool = self.incomplete.pop(index)
+                    self.awaiting_repair = False
+                    self.wdt.enable(self.inactivity_timeout)
+                return
+            if self.spool is None:
+                return
+
+        # Patch and parity fragments are collected until the checksum, lost
+        # fragments are then rebuilt from the parity fragments
+        if msg_type == self.UPDATE_TYPE_PATCH:
+            self.decoder.add_fragment(index, payload)
+            return
+        elif msg_type == self.UPDATE_TYPE_PARITY:
+            count = (payload[0] << 8) | payload[1]
+            self.decoder.add_parity(index, count, payload[2:])
+            return
+
+        if msg_type == self.UPDATE_TYPE_CHECKSUM:
+            # The digest is followed by the number of patch fragments
+            if len(payload) >= self.CHECKSUM_SIZE + 2:
+                self.decoder.set_count((payload[self.CHECKSUM_SIZE] << 8) | payload[self.CHECKSUM_SIZE + 1])
+            if not self.decoder.recover():
+                print("Lost patch fragments: {}".format(self.decoder.missing()))
+                self.keep_incomplete()
+                return
+            data = ubinascii.hexlify(payload[:self.CHECKSUM_SIZE]).decode()
+        else:
+            data = payload.decode()
+
+        self.process_update_msg(msg_type, data)
+
     def process_message(self, msg):
         self.wdt.ack()
 
+        if msg[0] & self.FRAME_FLAG:
+            self.process_frame(msg)
+            return
+
+        msg = msg.decode()
         msg_type = self.get_msg_type(msg)
         if msg_type == self.UPDATE_INFO_REPLY:
             self.parse_update_info_reply(msg)
@@ -472,13 +747,7 @@ class LoraOTA:
             self.parse_multicast_keys(msg)
         elif msg_type == self.LISTENING_REPLY:
             self.parse_listening_reply(msg)
-        elif msg_type == self.UPDATE_TYPE_FNAME:
-            self.process_filename_msg(msg)
-        elif msg_type == self.UPDATE_TYPE_PATCH:
-            self.process_patch_msg(msg)
-        elif msg_type == self.UPDATE_TYPE_CHECKSUM:
-            self.process_checksum_msg(msg)
-        elif msg_type == self.DELETE_FILE_MSG:
-            self.process_delete_msg(msg)
-        elif msg_type == self.MANIFEST_MSG:
-            self.process_manifest_msg(msg)
+        elif msg_type == self.MISSING_FRAGMENTS_REPLY:
+            self.parse_missing_fragments_reply(msg)
+        else:
+            self.process_update_msg(msg_type, self.get_msg_data(msg))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020, Pycom Limited.
+#
+# This software is licensed under the GNU GPL version 3 or any
+# later version, with permitted additional terms. For more information
+# see the Pycom Licence v1.0 document supplied with this file, or
+# available at https://www.pycom.io/opensource/licensing
+#
+
+import ubinascii
+import uhashlib
+
+# Patch of one file spooled to flash while it is received. Fragment i is
+# written at offset i * slot_size, so once complete the file holds the patch
+# text. Used as the fragment store of a FragmentDecoder.
+class PatchSpool:
+
+    def __init__(self, path, slot_size):
+        self.path = path
+        self.slot_size = slot_size
+        self._fh = open(path, 'w+b')
+        self._lengths = dict()
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def __contains__(self, index):
+        return index in self._lengths
+
+    def __iter__(self):
+        return iter(self._lengths)
+
+    def __getitem__(self, index):
+        self._fh.seek(index * self.slot_size)
+        return self._fh.read(self._lengths[index])
+
+    def __setitem__(self, index, data):
+        if index in self._lengths:
+            return
+        if len(data) > self.slot_size:
+            raise ValueError("Fragment larger than the spool slot")
+
+        self._fh.seek(index * self.slot_size)
+        self._fh.write(data)
+        self._lengths[index] = len(data)
+
+    def append(self, data):
+        self[len(self._lengths)] = data
+
+    # SHA1 of the first `count` fragments, or None while some are missing.
+    # The hash is computed in one go as the hardware supports only one
+    # hash operation at a time.
+    def hexdigest(self, count):
+        for i in range(count):
+            if i not in self._lengths:
+                return None
+
+        sha = uhashlib.sha1()
+        for i in range(count):
+            sha.update(self[i])
+        return ubinascii.hexlify(sha.digest()).decode()
+
+    def close(self):
+        self._fh.close()
@@ -13,7 +13,9 @@ import _thread
 
 class Watchdog:
 
-    def __init__(self):
+    # `callback` is called from the timer when the update fails
+    def __init__(self, callback=None):
+        self.callback = callback
         self.failed = False
         self.acknowledged = 0
         self._alarm = None
@@ -34,6 +36,9 @@ class Watchdog:
             else:
                 self.failed = True
 
+        if self.failed and self.callback is not None:
+            self.callback()
+
     def ack(self):
         with self._lock:
             self.acknowledged += 1
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020, Pycom Limited.
+#
+# This software is licensed under the GNU GPL version 3 or any
+# later version, with permitted additional terms. For more information
+# see the Pycom Licence v1.0 document supplied with this file, or
+# available at https://www.pycom.io/opensource/licensing
+#
+
+import ure
+
+# Applies a diff_match_patch patch file to a file without loading either of
+# them: the unchanged spans of the old file are copied to the new one in
+# blocks and the patch is read in chunks of a line. The patch must have been
+# made from exactly this old file, the context and deleted text of every hunk
+# is verified while copying.
+#
+# The hunk positions of diff_match_patch are relative to the text with the
+# previous hunks already applied, i.e. the output written so far followed by
+# the rest of the old file. The context of a hunk may reach back into the
+# previous one, so the end of the output is held back and given back to the
+# input when a hunk starts before it.
+class PatchApplier:
+
+    BLOCK_SIZE = 512
+    LINE_CHUNK = 256
+    # More than the context diff_match_patch adds around two hunks
+    HOLD_SIZE = 128
+
+    def __init__(self, dmp):
+        self.dmp = dmp
+        self._src = None
+        self._dst = None
+
+    # Writes the patched `src_path` (None for an empty file) to `dst_path`,
+    # returns False if the patch does not match the old file
+    def apply(self, patch_path, src_path, dst_path):
+        self._src = None
+        self._rewind = ''
+        self._held = ''
+        self._out_pos = 0
+        try:
+            if src_path is not None:
+                self._src = open(src_path, 'r')
+            with open(patch_path, 'r') as patch:
+                with open(dst_path, 'w') as dst:
+                    self._dst = dst
+                    if not self._apply(patch):
+                        return False
+                    dst.write(self._held)
+                    return True
+        except Exception as ex:
+            print("Error applying patch: {}".format(ex))
+        finally:
+            if self._src is not None:
+                self._src.close()
+            self._src = None
+            self._dst = None
+
+        return False
+
+    def _apply(self, patch):
+        line = patch.readline(self.LINE_CHUNK)
+        while line:
+            # Headers are short but may still be longer than a chunk
+            while not line.endswith('\n'):
+                more = patch.readline(self.LINE_CHUNK)
+                if not more:
+                    break
+                line += more
+
+            header = self._parse_header(line)
+            if header is None:
+                print("Invalid patch string: {}".format(line))
+                return False
+
+            start1, length1 = header
+            if start1 >= self._out_pos:
+                if not self._copy(start1 - self._out_pos):
+                    return False
+            else:
+                back = self._out_pos - start1
+                if back > len(self._held):
+                    return False
+                self._rewind = self._held[-back:] + self._rewind
+                self._held = self._held[:-back]
+                self._out_pos = start1
+
+            self._consumed = 0
+            line = self._apply_hunk(patch)
+            if line is None or self._consumed != length1:
+                return False
+
+        return self._copy(None)
+
+    def _parse_header(self, line):
+        m = ure.match("^@@ -(\\d+),?(\\d*) \\+(\\d+),?(\\d*) @@", line)
+        if not m:
+            return None
+
+        start1 = int(m.group(1))
+        if m.group(2) == '':
+            start1 -= 1
+            length1 = 1
+        elif m.group(2) == '0':
+            length1 = 0
+        else:
+            start1 -= 1
+            length1 = int(m.group(2))
+
+        return (start1, length1)
+
+    # Processes the lines of a hunk, returns the header of the next one, ''
+    # at the end of the patch or None if the hunk does not match
+    def _apply_hunk(self, patch):
+        while True:
+            chunk = patch.readline(self.LINE_CHUNK)
+            if not chunk or chunk[0] == '@':
+                return chunk
+
+            sign = chunk[0]
+            if sign == '\n':
+                continue
+
+            data = chunk[1:]
+            carry = ''
+            while True:
+                end = data.endswith('\n')
+                text = carry + (data[:-1] if end else data)
+
+                # Escape sequences may be split between two chunks
+                carry = ''
+                idx = text.rfind('%')
+                if not end and idx >= 0 and idx >= len(text) - 2:
+                    carry = text[idx:]
+                    text = text[:idx]
+
+                if not self._process(sign, self.dmp.unquote(text)):
+                    return None
+                if end:
+                    break
+
+                data = patch.readline(self.LINE_CHUNK)
+                if not data:
+                    return None if carry else ''
+
+    def _process(self, sign, text):
+        if sign == '+':
+            self._write(text)
+        elif sign == ' ':
+            if self._read(len(text)) != text:
+                return False
+            self._consumed += len(text)
+            self._write(text)
+        elif sign == '-':
+            if self._read(len(text)) != text:
+                return False
+            self._consumed += len(text)
+        else:
+            print("Invalid patch mode: {}".format(sign))
+            return False
+
+        return True
+
+    def _read(self, size):
+        data = ''
+        if len(self._rewind) > 0:
+            data = self._rewind[:size]
+            self._rewind = self._rewind[size:]
+        if len(data) < size and self._src is not None:
+            data += self._src.read(size - len(data))
+
+        return data
+
+    def _write(self, text):
+        self._out_pos += len(text)
+        self._held += text
+        if len(self._held) > self.HOLD_SIZE:
+            self._dst.write(self._held[:-self.HOLD_SIZE])
+            self._held = self._held[-self.HOLD_SIZE:]
+
+    # Copies `size` characters of the old file, or up to its end if None
+    def _copy(self, size):
+        while size is None or size > 0:
+            if size is None:
+                data = self._read(self.BLOCK_SIZE)
+            else:
+                data = self._read(min(size, self.BLOCK_SIZE))
+            if not data:
+                return size is None
+            self._write(data)
+            if size is not None:
+                size -= len(data)
+
+        return True
@@ -8,19 +8,156 @@
 # available at https://www.pycom.io/opensource/licensing
 #
 
-import diff_match_patch as dmp_module
-import threading
+import asyncio
+import config
+import math
+import fec
 import hashlib
 import binascii
 import filecmp
+import struct
 import json
 import time
 import os
 
+# Spreading factor and bandwidth (kHz) of the downlink data rates per region
+_EU_DATA_RATES = {0: (12, 125), 1: (11, 125), 2: (10, 125), 3: (9, 125), 4: (8, 125), 5: (7, 125), 6: (7, 250)}
+_US_DATA_RATES = {8: (12, 500), 9: (11, 500), 10: (10, 500), 11: (9, 500), 12: (8, 500), 13: (7, 500)}
+DATA_RATES = {
+    'EU868': _EU_DATA_RATES,
+    'AS923': _EU_DATA_RATES,
+    'IN865': _EU_DATA_RATES,
+    'US915': _US_DATA_RATES,
+    'AU915': _US_DATA_RATES
+}
+
+# MHDR, FHDR without options, FPort and MIC around the application payload
+LORAWAN_OVERHEAD = 13
+
+# Time on air in seconds of a LoRaWAN downlink carrying `size` bytes of
+# application payload (coding rate 4/5, 8 symbol preamble, no payload CRC)
+def downlink_airtime(size, sf, bw):
+    t_sym = (2 ** sf) / (bw * 1000.0)
+    de = 1 if t_sym > 0.016 else 0
+    pl = size + LORAWAN_OVERHEAD
+    n_payload = 8 + max(math.ceil((8 * pl - 4 * sf + 28) / (4.0 * (sf - 2 * de))) * 5, 0)
+
+    return (8 + 4.25 + n_payload) * t_sym
+
+# Spaces the downlinks of all update sessions so the gateway stays within the
+# duty cycle of the downlink sub-band. Shared by the sessions, as they are
+# transmitted by the same radio.
+class AirtimeBudget:
+
+    def __init__(self, region, datarate, duty_cycle):
+        self.sf, self.bw = DATA_RATES[region][datarate]
+        self.duty_cycle = duty_cycle
+        self._next_slot = 0.0
+
+    def airtime(self, size):
+        return downlink_airtime(size, self.sf, self.bw)
+
+    # Waits until a downlink of `size` bytes may be sent, runs on the event loop
+    async def reserve(self, size):
+        now = time.monotonic()
+        start = max(now, self._next_slot)
+        self._next_slot = start + self.airtime(size) / self.duty_cycle
+        if start > now:
+            await asyncio.sleep(start - now)
+
+# Enqueues the downlinks of one multicast group at the pace allowed by the
+# airtime budget, keeping at most `queue_depth` of them in the network server
+# queue: enough so transmissions follow each other without gaps, few enough
+# that the network server never sends faster than the duty cycle allows.
+class MulticastPacer:
+
+    # Lower bound between two reads of the multicast queue
+    MIN_POLL_INTERVAL = 0.5
+
+    # Attempts to enqueue a downlink the network server refused, waiting
+    # RETRY_BACKOFF * 2^n seconds between attempts
+    MAX_ATTEMPTS = 3
+    RETRY_BACKOFF = 1.0
+
+    def __init__(self, ota_obj, clientApp, jwt, multicast_id, budget, queue_depth):
+        self.ota = ota_obj
+        self._clientApp = clientApp
+        self._loraserver_jwt = jwt
+        self._multicast_group_id = multicast_id
+        self._budget = budget
+        self.queue_depth = queue_depth
+
+        # Frame counter for the next enqueued downlink, read from the
+        # multicast group on the first downlink
+        self._fcnt = None
+        # Downlinks enqueued and possibly not sent yet
+        self._queued = 0
+        self._airtime = 0.0
+        # Downlinks dropped after all attempts to enqueue them failed
+        self.dropped = 0
+
+    async def send(self, msgs):
+        i = 0
+        while i < len(msgs):
+            await self._wait_queue(self.queue_depth - 1)
+
+            # The free places of the queue are filled with one batch
+            batch = msgs[i:i + self.queue_depth - self._queued]
+            for msg in batch:
+                await self._budget.reserve(len(msg))
+            self._airtime = self._budget.airtime(len(batch[-1]))
+
+            await self._enqueue(batch)
+            i += len(batch)
+
+    async def _enqueue(self, batch):
+        attempt = 0
+        while len(batch) > 0:
+            fcnt, sent = await self.ota.run_io(self._clientApp.send_batch, self._loraserver_jwt, self._multicast_group_id, batch, self._fcnt)
+            self._queued += sent
+            if fcnt >= 0:
+                self._fcnt = fcnt
+                return
+
+            # Re-read the frame counter from the group for the next attempt,
+            # only the downlinks not enqueued yet are sent again
+            self._fcnt = None
+            batch = batch[sent:]
+            attempt = attempt + 1 if sent == 0 else 1
+            if attempt >= self.MAX_ATTEMPTS:
+                # Lost as if missed over the air, binary sessions repair it
+                self.dropped += 1
+                print("Dropped a downlink of multicast group {} ({} in total)".format(self._multicast_group_id, self.dropped))
+                batch = batch[1:]
+                attempt = 0
+                continue
+            await asyncio.sleep(self.RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    # Waits until the network server has sent all enqueued downlinks
+    async def drain(self):
+        await self._wait_queue(0)
+
+    # Waits until at most `limit` downlinks are left in the queue
+    async def _wait_queue(self, limit):
+        while self._queued > limit:
+            length = await self.ota.run_io(self._clientApp.multicast_queue_length, self._loraserver_jwt, self._multicast_group_id)
+            if length >= 0:
+                self._queued = length
+            if self._queued > limit:
+                # Roughly the time for the next downlink to go out
+                await asyncio.sleep(max(self.MIN_POLL_INTERVAL, self._airtime))
+
 class updateHandler:
+
+    # Patch fragment sizes, chosen so both framings use frames of the same
+    # size over the air (parity frames carry the fragment count as well)
+    ASCII_FRAGMENT_SIZE = 200
+    BINARY_FRAGMENT_SIZE = 203
+
     
-    def __init__(self, dev_version, latest_version, clientApp, jwt, multicast_id, ota_obj):
-        self.tag = dev_version + ',' + latest_version
+    def __init__(self, dev_version, latest_version, clientApp, jwt, multicast_id, ota_obj, session_id=None):
+        self.tag = ota_obj.cohort_key(dev_version, latest_version, session_id is not None)
+        self.session_id = session_id
         self.oper_dict = None
         self.patch_dict = None
         self.dev_version = dev_version
@@ -28,15 +165,20 @@ class updateHandler:
         self._clientApp = clientApp
         self.ota =ota_obj
         self.max_send = 5
+        self.fec_redundancy = config.FEC_REDUNDANCY
+        self.fec_min_parity = config.FEC_MIN_PARITY
         
         self._loraserver_jwt = jwt
         self._multicast_group_id = multicast_id
+        self._pacer = MulticastPacer(ota_obj, clientApp, jwt, multicast_id, ota_obj.airtime_budget, config.MULTICAST_QUEUE_DEPTH)
+
+        # Fragments of each file by file index, and the fragments the devices
+        # reported lost
+        self._files = []
+        self._repairs = dict()
         
         self._binary_ext = []
         
-        self._m_th = threading.Thread(target=self._multicast_proc)
-        self._m_th.start()
-        
     def print_file_operations(self, oper_dict):
         if 'delete_txt' in oper_dict:
             print('Delete text: {}'.format(oper_dict['delete_txt']))
@@ -140,69 +282,96 @@ class updateHandler:
     def chunkstring(self, string, length):
         return list(string[0+i:length+i] for i in range(0, len(string), length))
     
-    def _send_delete_msg(self, filename):
-        msg = bytearray()
-        msg.extend(self.ota.MSG_HEADER)
-        msg.extend(b',' + str(self.ota.DELETE_FILE_MSG).encode())
-        msg.extend(b',' + filename.encode())
-        msg.extend(b',' + self.ota.MSG_TAIL)
-        
-        self._clientApp.send(self._loraserver_jwt, self._multicast_group_id, msg)
-    
-    def _send_delete_operations(self, oper_dict):
+    async def _send_delete_operations(self, oper_dict):
+        msgs = []
         for key, value in oper_dict.items():
             if key in ['delete_txt', 'delete_bin']:
                 for filename in value:
-                    self._send_delete_msg(filename[6:])
+                    msgs.append(self._create_multicast_msg(self.ota.DELETE_FILE_MSG, filename[6:], len(msgs)))
+
+        await self._pacer.send(msgs)
         
-    def _send_patches(self, patch_dict):
-        for fname in patch_dict:
-            #send file name to patch
-            self._send_multicast_msg(self.ota.UPDATE_TYPE_FNAME, fname)
-            time.sleep(3)
-            patch_list = self.chunkstring(patch_dict[fname][0], 200)
-            patch_idx = 0
-            for p in patch_list:
-                patch_idx += len(p)
-                # send segmented patch
-                self._send_multicast_msg(self.ota.UPDATE_TYPE_PATCH, p)
-                time.sleep(3)
+    async def _send_patches(self, patch_dict):
+        if self.session_id is not None:
+            fragment_size = self.BINARY_FRAGMENT_SIZE
+        else:
+            fragment_size = self.ASCII_FRAGMENT_SIZE
+
+        for file_idx, fname in enumerate(patch_dict):
+            # file name, segmented patch and checksum are enqueued in one pass
+            msgs = [self._create_multicast_msg(self.ota.UPDATE_TYPE_FNAME, fname, file_idx)]
+            patch_list = self.chunkstring(patch_dict[fname][0], fragment_size)
+            for patch_idx, p in enumerate(patch_list):
+                msgs.append(self._create_multicast_msg(self.ota.UPDATE_TYPE_PATCH, p, patch_idx))
+            if self.session_id is not None:
+                msgs.extend(self._create_parity_msgs(patch_list, fragment_size))
             checksum = patch_dict[fname][1]
-            # Send checksum
-            self._send_multicast_msg(self.ota.UPDATE_TYPE_CHECKSUM, checksum)
-            time.sleep(3)
-            
-    def _send_multicast_msg(self, msg_type, data):
-        
+            msgs.append(self._create_checksum_msg(checksum, file_idx, len(patch_list)))
+            self._files.append((fname, patch_list, checksum))
+
+            await self._pacer.send(msgs)
+
+    def _create_multicast_msg(self, msg_type, data, index=0):
+        if self.session_id is not None:
+            return self._create_frame(msg_type, data, index)
+
         msg = bytearray()
         msg.extend(self.ota.MSG_HEADER)
         msg.extend(b',' + str(msg_type).encode())
         msg.extend(b',' + data.encode())
         msg.extend(b',' + self.ota.MSG_TAIL)
-        
-        self._clientApp.send(self._loraserver_jwt, self._multicast_group_id, msg)
-        
-    def _send_manifest_msg(self):
-        msg = bytearray()
-        msg.extend(self.ota.MSG_HEADER)
-        msg.extend(b',' + str(self.ota.UPDATE_TYPE_RESTART).encode())
-        msg.extend(b',' + self.ota.MSG_TAIL)
 
-        self._clientApp.send(self._loraserver_jwt, self._multicast_group_id, msg)
-    
-    def _create_file_patch(self, left, right, fileList):
-        patch_dict = dict()
+        return msg
+
+    def _create_frame(self, msg_type, data, index):
+        frame = bytearray(struct.pack('>BBH', self.ota.FRAME_FLAG | msg_type, self.session_id, index))
+        if msg_type == self.ota.UPDATE_TYPE_CHECKSUM:
+            # raw digest instead of its hex representation
+            frame.extend(binascii.unhexlify(data))
+        elif isinstance(data, str):
+            frame.extend(data.encode())
+        else:
+            frame.extend(data)
+
+        return frame
+
+    def _create_checksum_msg(self, checksum, file_idx, count):
+        msg = self._create_multicast_msg(self.ota.UPDATE_TYPE_CHECKSUM, checksum, file_idx)
+        if self.session_id is not None:
+            # The devices learn the number of fragments even if the last
+            # ones were lost
+            msg.extend(struct.pack('>H', count))
 
-        for f in fileList:
-            left_text = self._read_firware_file(left + '/' + f)
-            right_text = self._read_firware_file(right + '/' + f)
+        return msg
 
-            dmp = dmp_module.diff_match_patch()
+    def _create_parity_msgs(self, patch_list, fragment_size):
+        # Parity fragments let the devices rebuild lost patch fragments, see
+        # fec.py. Each one is preceded by the number of patch fragments.
+        fragments = [p.encode() for p in patch_list]
+        count = len(fragments)
+        if count == 0:
+            return []
+        parity_count = max(self.fec_min_parity, int(math.ceil(count * self.fec_redundancy)))
 
-            # Execute one reverse diff as a warmup.
-            patch_lst = dmp.patch_make(left_text, right_text)
-            patch_str = dmp.patch_toText(patch_lst)
+        msgs = []
+        for n in range(1, parity_count + 1):
+            parity = fec.parity_fragment(fragments, n, fragment_size)
+            msgs.append(self._create_frame(self.ota.UPDATE_TYPE_PARITY, struct.pack('>H', count) + parity, n))
 
+        return msgs
+
+    def _read_text_pairs(self, left, right, fileList):
+        return [(self._read_firware_file(left + '/' + f), self._read_firware_file(right + '/' + f)) for f in fileList]
+
+    async def _create_file_patch(self, left, right, fileList):
+        patch_dict = dict()
+
+        # The patches are generated in parallel, or read from the cache
+        text_pairs = await self.ota.run_io(self._read_text_pairs, left, right, fileList)
+        futures = [asyncio.wrap_future(self.ota.patch_cache.submit(l, r)) for l, r in text_pairs]
+        patches = await asyncio.gather(*futures)
+
+        for f, patch_str in zip(fileList, patches):
             print("File name: {}".format(f))
             print("Patch : {}".format(patch_str))
 
@@ -226,47 +395,92 @@ class updateHandler:
 
         return oper_dict
     
-    def _create_patches(self, device_version, update_version, oper_dict):
+    async def _create_patches(self, device_version, update_version, oper_dict):
         patch_dict = dict()
 
         left = self.ota.firmware_dir + '/' + device_version
         right = self.ota.firmware_dir + '/' + update_version
 
         if 'update_txt' in oper_dict:
-            update_dict = self._create_file_patch(left, right, oper_dict['update_txt'])
+            update_dict = await self._create_file_patch(left, right, oper_dict['update_txt'])
             patch_dict.update(update_dict)
 
         if 'new_txt' in oper_dict:
-            new_dict = self._create_file_patch(left, right, oper_dict['new_txt'])
+            new_dict = await self._create_file_patch(left, right, oper_dict['new_txt'])
             patch_dict.update(new_dict)
 
         return patch_dict
     
-    def _send_manifest_msg(self):
+    def _create_manifest_msgs(self):
         manifest = self._create_manifest(self.oper_dict)
         print('Manifest: {}'.format(manifest))
         
+        msgs = []
         for i in (0, self.max_send):
-            self._send_multicast_msg(self.ota.MANIFEST_MSG, manifest)
-            time.sleep(4)
-        
-    def _multicast_proc(self):
-        
-        self.oper_dict = self.file_operations(self.dev_version, self.latest_version)
-        self.patch_dict = self._create_patches(self.dev_version, self.latest_version, self.oper_dict)
-        
-        self._send_patches(self.patch_dict)
-        self._send_delete_operations(self.oper_dict)
-        self._send_manifest_msg()
-        
-        while not self.ota.is_empty_multicast_queue(self._loraserver_jwt, self._multicast_group_id):
-            time.sleep(1)
-        
-        self.ota.clear_multicast_group(self.tag)
-        
-    
-    
+            msgs.append(self._create_multicast_msg(self.ota.MANIFEST_MSG, manifest, len(msgs)))
+
+        return msgs
+
+    async def _send_manifest_msg(self):
+        await self._pacer.send(self._create_manifest_msgs())
+
+    # Called on the event loop when a device reports lost fragments
+    def add_repair(self, file_idx, missing):
+        if file_idx >= len(self._files):
+            return
+
+        count = len(self._files[file_idx][1])
+        self._repairs.setdefault(file_idx, set()).update(i for i in missing if i < count)
+
+    # Sends the fragments lost by any device, followed by the checksum of
+    # their file and the manifest again
+    async def _send_repairs(self):
+        repairs = self._repairs
+        self._repairs = dict()
+
+        msgs = []
+        for file_idx in sorted(repairs):
+            fname, patch_list, checksum = self._files[file_idx]
+            print('Repair {}: {} of {} fragments'.format(fname, len(repairs[file_idx]), len(patch_list)))
+            msgs.append(self._create_multicast_msg(self.ota.UPDATE_TYPE_FNAME, fname, file_idx))
+            for patch_idx in sorted(repairs[file_idx]):
+                msgs.append(self._create_multicast_msg(self.ota.UPDATE_TYPE_PATCH, patch_list[patch_idx], patch_idx))
+            msgs.append(self._create_checksum_msg(checksum, file_idx, len(patch_list)))
+        msgs.extend(self._create_manifest_msgs())
+
+        await self._pacer.send(msgs)
         
-    
-    
-    
+    # Runs the update session on the event loop of the OTAHandler, all blocking
+    # work is done in its I/O worker pool
+    async def run(self):
+
+        try:
+            await self._run_session()
+        except asyncio.CancelledError:
+            # Stopped with the service, the multicast group is kept and the
+            # session resumed by the next run
+            raise
+        except Exception as ex:
+            print("Exception in the update session {}: {}".format(self.tag, ex))
+
+        await self.ota.run_io(self.ota.clear_multicast_group, self.tag)
+
+    async def _run_session(self):
+
+        self.oper_dict = await self.ota.run_io(self.file_operations, self.dev_version, self.latest_version)
+        self.patch_dict = await self._create_patches(self.dev_version, self.latest_version, self.oper_dict)
+
+        await self._send_patches(self.patch_dict)
+        await self._send_delete_operations(self.oper_dict)
+        await self._send_manifest_msg()
+        await self._pacer.drain()
+
+        # Devices which could not rebuild a file report the lost fragments
+        # after the manifest
+        if self.session_id is not None:
+            for i in range(config.REPAIR_ROUNDS):
+                await asyncio.sleep(config.REPAIR_WINDOW)
+                if len(self._repairs) == 0:
+                    break
+                await self._send_repairs()
+                await self._pacer.drain()
@@ -10,14 +10,36 @@
 
 from distutils.version import LooseVersion
 from LoraServer import LoraServerClient
-from groupUpdater import updateHandler
+from groupUpdater import updateHandler, AirtimeBudget
+from patchCache import PatchCache
+from deviceRegistry import DeviceRegistry
+from concurrent.futures import ThreadPoolExecutor
 import threading
+import asyncio
+import binascii
 import json
 import base64
+import fec
 import os
 import time
 import config
 
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    # The firmware directory is polled instead
+    Observer = None
+    FileSystemEventHandler = object
+
+class FirmwareEventHandler(FileSystemEventHandler):
+
+    def __init__(self, callback):
+        self._callback = callback
+
+    def on_any_event(self, event):
+        self._callback()
+
 
 class OTAHandler:
 
@@ -44,6 +66,15 @@ class OTAHandler:
 
     DELETE_FILE_MSG = 10
     MANIFEST_MSG = 11
+    UPDATE_TYPE_PARITY = 12
+
+    MISSING_FRAGMENTS_MSG = 13
+    MISSING_FRAGMENTS_REPLY = 14
+
+    # Binary framing of the multicast update messages, negotiated in the
+    # UPDATE_INFO exchange: <0x80 | type> <session id> <index (2 bytes)> <data>
+    BINARY_FRAMING = 'B'
+    FRAME_FLAG = 0x80
 
     def __init__(self):
         self._exit = False
@@ -53,44 +84,142 @@ class OTAHandler:
         self.firmware_dir = './firmware'
 
         self._next_update = -1
-        self._update_timer = None
+        self._update_task = None
         self._update_delay = config.UPDATE_DELAY
-        self._device_dict = dict()
-        self._keys_dict = dict()
+        self.registry = DeviceRegistry(config.REGISTRY_DB)
+        self._session_id = os.urandom(1)[0]
+
+        self.patch_cache = PatchCache(config.PATCH_CACHE_DIR, config.DIFF_TIMEOUT, config.PATCH_WORKERS)
 
         self._clientApp = LoraServerClient()
         self._loraserver_jwt = None
 
         self._service_profile = config.LORASERVER_SERVICE_PROFILE
+        self._service_profile_id = None
+        self._profile_lock = threading.Lock()
         self._downlink_datarate = config.LORASERVER_DOWNLINK_DR
         self._downlink_freq = config.LORASERVER_DOWNLINK_FREQ
+        self.airtime_budget = AirtimeBudget(config.LORASERVER_REGION, self._downlink_datarate, config.DOWNLINK_DUTY_CYCLE)
 
-        self._m_th = threading.Thread(target=self._firmware_monitor)
-        self._m_th.start()
-
-        self.multicast_updaters = []
+        self.multicast_updaters = dict()
         self._updater_lock = threading.Lock()
 
+        # Session ids of the cohorts whose multicast group is being created,
+        # and devices waiting to be added to the group of their cohort
+        self._pending_cohorts = dict()
+        self._enrolments = dict()
+        self._enrol_event = None
+
+        # All update sessions run on one event loop, the blocking REST and
+        # file system calls go to a bounded worker pool
+        self._loop = asyncio.new_event_loop()
+        self._io_pool = ThreadPoolExecutor(max_workers=config.IO_WORKERS)
+        self._observer = None
+        self._scan_handle = None
+
+        self._loop_th = threading.Thread(target=self._loop_proc)
+        self._loop_th.start()
+
     def stop(self):
         self._exit = True
+        if self._observer is not None:
+            self._observer.stop()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._io_pool.shutdown(wait=False)
+        self.patch_cache.stop()
 
     def set_mqtt_client(self, client):
         self.p_client = client
 
-    def _firmware_monitor(self):
-        self._loraserver_jwt = self._clientApp.login()
-
+    def run_io(self, func, *args):
+        return self._loop.run_in_executor(self._io_pool, func, *args)
+
+    def _loop_proc(self):
+        asyncio.set_event_loop(self._loop)
+        self._enrol_event = asyncio.Event()
+        self._loop.create_task(self._firmware_monitor())
+        self._loop.create_task(self._enrolment_proc())
+        self._loop.create_task(self._registry_proc())
+        self._loop.run_forever()
+
+        # Cancel the sessions still running when stopped
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.close()
+        self.registry.close()
+
+    # The registry changes are committed in batches by the I/O workers,
+    # keeping the disk writes out of the uplink processing
+    async def _registry_proc(self):
         while not self._exit:
-            with self._v_lock:
-                self._latest_version = self._check_version()
-
-            time.sleep(5)
+            await asyncio.sleep(config.REGISTRY_FLUSH_INTERVAL)
+            try:
+                await self.run_io(self.registry.flush)
+            except Exception as ex:
+                print("Exception writing the device registry: {}".format(ex))
+
+    async def _firmware_monitor(self):
+        self._loraserver_jwt = await self.run_io(self._clientApp.login)
+        await self._update_latest_version()
+        self._resume_updates()
+
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(FirmwareEventHandler(self._on_firmware_event), self.firmware_dir, recursive=True)
+            self._observer.start()
+            return
+
+        last_mtime = None
+        while not self._exit:
+            try:
+                mtime = os.stat(self.firmware_dir).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != last_mtime:
+                last_mtime = mtime
+                self._firmware_changed()
+
+            await asyncio.sleep(config.FIRMWARE_POLL_INTERVAL)
+
+    def _on_firmware_event(self, *args):
+        # Called from the observer thread
+        self._loop.call_soon_threadsafe(self._firmware_changed)
+
+    def _firmware_changed(self):
+        # Rescan once the directory has settled, e.g. after copying a version
+        if self._scan_handle is not None:
+            self._scan_handle.cancel()
+        self._scan_handle = self._loop.call_later(config.FIRMWARE_SETTLE_TIME, self._scan_firmware)
+
+    def _scan_firmware(self):
+        self._scan_handle = None
+        self._loop.create_task(self._update_latest_version())
+
+    async def _update_latest_version(self):
+        latest = await self.run_io(self._check_version)
+        with self._v_lock:
+            if latest != self._latest_version:
+                print("Latest firmware version: {}".format(latest))
+            self._latest_version = latest
 
     def process_rx_msg(self, payload):
+        dev_eui, dev_msg = self.parse_uplink(payload)
+        self.process_uplink(dev_eui, dev_msg)
 
-        dev_eui = self.get_device_eui(payload)
-        dev_msg = self.decode_device_msg(payload)
-        if self.MSG_HEADER in dev_msg:
+    # Returns the device EUI and the decoded data of an uplink event
+    def parse_uplink(self, payload):
+        try:
+            rx_pkt = json.loads(payload)
+        except Exception as ex:
+            print("Exception parsing uplink")
+            return (None, None)
+
+        return (self.get_device_eui(rx_pkt), self.decode_device_msg(rx_pkt))
+
+    def process_uplink(self, dev_eui, dev_msg):
+        if dev_eui is not None and dev_msg is not None and self.MSG_HEADER in dev_msg:
             msg_type = self.get_msg_type(dev_msg.decode())
             if msg_type == self.UPDATE_INFO_MSG:
                 self._send_update_info(dev_eui, dev_msg.decode())
@@ -98,6 +227,8 @@ class OTAHandler:
                 self._send_multicast_keys(dev_eui)
             elif msg_type == self.LISTENING_MSG:
                 self._send_listening_reply(dev_eui)
+            elif msg_type == self.MISSING_FRAGMENTS_MSG:
+                self._process_missing_fragments(dev_eui, dev_msg.decode())
 
     def _send_listening_reply(self, dev_eui):
 
@@ -108,15 +239,43 @@ class OTAHandler:
 
         self.send_payload(dev_eui, msg)
 
+    # A device could not rebuild a file of the update, the lost fragments are
+    # sent again to the multicast group once the update session is over
+    def _process_missing_fragments(self, dev_eui, msg):
+        try:
+            token_msg = msg.split(",")
+            session_id = int(token_msg[2])
+            file_idx = int(token_msg[3])
+            count = int(token_msg[4])
+            missing = fec.bitmap_fragments(binascii.unhexlify(token_msg[5]), count)
+        except Exception as ex:
+            print("Exception parsing missing fragments: {}".format(ex))
+            return
+
+        with self._updater_lock:
+            updater = self.multicast_updaters.get(self.registry.device_cohort(dev_eui))
+        if updater is None or updater.session_id != session_id:
+            return
+
+        print("Device eui: {}, file {} missing fragments: {}".format(dev_eui, file_idx, missing))
+        self._loop.call_soon_threadsafe(updater.add_repair, file_idx, missing)
+
+        msg = bytearray()
+        msg.extend(self.MSG_HEADER)
+        msg.extend(b',' + str(self.MISSING_FRAGMENTS_REPLY).encode())
+        msg.extend(b',' + self.MSG_TAIL)
+
+        self.send_payload(dev_eui, msg)
+
     def _send_multicast_keys(self, dev_eui):
 
         msg = bytearray()
         msg.extend(self.MSG_HEADER)
         msg.extend(b',' + str(self.MULTICAST_KEY_REPLY).encode())
 
-        if dev_eui in self._device_dict:
-            multicast_param_key = self._device_dict[dev_eui]
-            multicast_param = self._keys_dict[multicast_param_key]
+        cohort = self.registry.get_cohort(self.registry.device_cohort(dev_eui))
+        if cohort is not None:
+            multicast_param = cohort["group"]
 
             msg.extend(b',' + multicast_param[1])
             msg.extend(b',' + multicast_param[2])
@@ -128,10 +287,10 @@ class OTAHandler:
 
         self.send_payload(dev_eui, msg)
 
-    def get_device_eui(self, payload):
+    def get_device_eui(self, rx_pkt):
         dev_eui = None
         try:
-            dev_eui = json.loads(payload)["devEUI"]
+            dev_eui = rx_pkt["devEUI"]
         except Exception as ex:
             print("Exception extracting device eui")
 
@@ -147,35 +306,123 @@ class OTAHandler:
 
         return msg_type
 
-    def decode_device_msg(self, payload):
+    def decode_device_msg(self, rx_pkt):
         dev_msg = None
         try:
-            rx_pkt = json.loads(payload)
             dev_msg = base64.b64decode(rx_pkt["data"])
         except Exception as ex:
             print("Exception decoding device message")
         return dev_msg
 
+    def _get_service_profile_id(self):
+        # Looked up once, groups of several cohorts may be created at once
+        with self._profile_lock:
+            if self._service_profile_id is None:
+                self._service_profile_id = self._clientApp.request_service_profile_id(self._service_profile, self._loraserver_jwt)
+
+            return self._service_profile_id
+
     def _create_multicast_group(self, update_info):
-        service_id = self._clientApp.request_service_profile_id(self._service_profile, self._loraserver_jwt)
+        service_id = self._get_service_profile_id()
 
         group_name = update_info.replace(',','-')
         multicast_param = self._clientApp.create_multicast_group(self._downlink_datarate, self._downlink_freq, group_name, service_id, self._loraserver_jwt)
 
         return multicast_param
 
-    def _init_update_params(self, dev_eui, dev_version, latest_version):
-        if self._next_update <= 0:
-            self._next_update = int(time.time()) + self._update_delay
-            self._update_timer = threading.Timer(self._update_delay, self.update_proc)
-            self._update_timer.start()
+    def cohort_key(self, dev_version, latest_version, binary_framing):
+        key = dev_version.strip() + ',' + latest_version.strip()
+        if binary_framing:
+            key += ',' + self.BINARY_FRAMING
+        return key
+
+    def _new_session_id(self):
+        self._session_id = (self._session_id + 1) % 256
+        return self._session_id
+
+    def _init_update_params(self, dev_eui, dev_version, latest_version, binary_framing):
+        # Uplinks are processed by several workers at once
+        with self._updater_lock:
+            if self._next_update <= 0:
+                self._next_update = int(time.time()) + self._update_delay
+                self._update_task = asyncio.run_coroutine_threadsafe(self._delayed_update(self._update_delay), self._loop)
+
+            # Devices using different framings are updated in separate groups.
+            # The multicast group of a cohort is created once, in the
+            # background, without holding up the uplink processing.
+            update_info = self.cohort_key(dev_version, latest_version, binary_framing)
+            if self.registry.get_cohort(update_info) is None and update_info not in self._pending_cohorts:
+                session_id = self._new_session_id() if binary_framing else None
+                self._pending_cohorts[update_info] = session_id
+                asyncio.run_coroutine_threadsafe(self._create_cohort(update_info, session_id, self._next_update), self._loop)
+
+            device = self.registry.get_device(dev_eui)
+            if device is not None and device["cohort"] == update_info and device["status"] == DeviceRegistry.STATUS_ENROLLED:
+                self.registry.update_device(dev_eui, dev_version)
+                return
+
+            self.registry.update_device(dev_eui, dev_version, update_info, DeviceRegistry.STATUS_PENDING)
+            self._enrolments.setdefault(update_info, set()).add(dev_eui)
+
+        self._loop.call_soon_threadsafe(self._enrol_event.set)
+
+    async def _create_cohort(self, cohort, session_id, update_time):
+        try:
+            multicast_param = await self.run_io(self._create_multicast_group, cohort)
+        except Exception as ex:
+            print("Exception creating the multicast group of {}: {}".format(cohort, ex))
+            multicast_param = None
+
+        with self._updater_lock:
+            del self._pending_cohorts[cohort]
+            if multicast_param is None:
+                # Retried with the next uplink of the cohort
+                print("Error creating the multicast group of {}".format(cohort))
+                return
+            self.registry.add_cohort(cohort, multicast_param, session_id, update_time)
+
+        self._enrol_event.set()
+
+    def _cohort_session_id(self, cohort):
+        with self._updater_lock:
+            if cohort in self._pending_cohorts:
+                return self._pending_cohorts[cohort]
+
+        record = self.registry.get_cohort(cohort)
+        if record is not None:
+            return record["session_id"]
 
-        update_info = dev_version.strip() + ',' + latest_version.strip()
-        self._device_dict[dev_eui] = update_info
-        if update_info not in self._keys_dict:
-            multicast_param = self._create_multicast_group(update_info)
-            self._keys_dict[update_info] = multicast_param
-            self._clientApp.add_device_multicast_group(dev_eui, multicast_param[0], self._loraserver_jwt)
+        return None
+
+    async def _enrolment_proc(self):
+        while not self._exit:
+            await self._enrol_event.wait()
+            # Let the enrolments of a burst of uplinks accumulate
+            await asyncio.sleep(config.ENROLMENT_INTERVAL)
+            self._enrol_event.clear()
+            await self._flush_enrolments()
+
+    async def _flush_enrolments(self):
+        jobs = []
+        with self._updater_lock:
+            for cohort in list(self._enrolments):
+                record = self.registry.get_cohort(cohort)
+                # Enrolled once the multicast group has been created
+                if record is None:
+                    continue
+                for dev_eui in self._enrolments.pop(cohort):
+                    jobs.append(self._enrol_device(cohort, record["group"][0], dev_eui))
+
+        # The requests are limited by the size of the I/O worker pool
+        await asyncio.gather(*jobs)
+
+    async def _enrol_device(self, cohort, group_id, dev_eui):
+        if await self.run_io(self._clientApp.add_device_multicast_group, dev_eui, group_id, self._loraserver_jwt):
+            self.registry.set_device_status(dev_eui, DeviceRegistry.STATUS_ENROLLED)
+        else:
+            with self._updater_lock:
+                self._enrolments.setdefault(cohort, set()).add(dev_eui)
+            self._enrol_event.set()
 
     def _send_update_info(self, dev_eui, msg):
         print(msg)
@@ -185,8 +432,15 @@ class OTAHandler:
         if len(dev_version) > 0:
             version = self.get_latest_version()
             if LooseVersion(version) > LooseVersion(dev_version):
-                self._init_update_params(dev_eui, dev_version, version)
-            msg = self._create_update_info_msg(version, dev_version)
+                binary_framing = self.get_device_framing(msg) == self.BINARY_FRAMING
+                self._init_update_params(dev_eui, dev_version, version, binary_framing)
+            elif self.registry.device_cohort(dev_eui) is None:
+                self.registry.update_device(dev_eui, dev_version, status=DeviceRegistry.STATUS_IDLE)
+            else:
+                self.registry.update_device(dev_eui, dev_version)
+
+            session_id = self._cohort_session_id(self.registry.device_cohort(dev_eui))
+            msg = self._create_update_info_msg(version, dev_version, session_id)
             self.send_payload(dev_eui, msg)
 
     def get_device_version(self, msg):
@@ -198,6 +452,14 @@ class OTAHandler:
 
         return dev_version
 
+    def get_device_framing(self, msg):
+        # Devices supporting the binary framing advertise it after the version
+        token_msg = msg.split(",")
+        if len(token_msg) > 4:
+            return token_msg[3]
+
+        return None
+
     def _check_version(self):
         latest = '0.0.0'
         for d in os.listdir(self.firmware_dir):
@@ -212,39 +474,64 @@ class OTAHandler:
         with self._v_lock:
             return self._latest_version
 
-    def is_empty_multicast_queue(self, jwt, multicast_group_id):
-        queue_length =self._clientApp.multicast_queue_length(jwt, multicast_group_id)
-        if queue_length > 0:
-            return False
-        else:
-            return True
-
     def clear_multicast_group(self, dict_key):
         with self._updater_lock:
-            if dict_key in self._keys_dict:
-                group_id = self._keys_dict[dict_key][0]
-                self._clientApp.delete_multicast_group(group_id)
-                del self._keys_dict[dict_key]
+            cohort = self.registry.get_cohort(dict_key)
+            self.registry.remove_cohort(dict_key, DeviceRegistry.STATUS_SENT)
 
-            self._device_dict = {key:val for key, val in self._device_dict.items() if val != dict_key}
-
-            for updater in self.multicast_updaters:
-                if updater.tag == dict_key:
-                    self.multicast_updaters.remove(updater)
+            self.multicast_updaters.pop(dict_key, None)
 
             if len(self.multicast_updaters) == 0:
                 self._next_update = -1
-                self._update_timer = None
+                self._update_task = None
+
+        # The lock is shared with the event loop and the uplink workers, the
+        # REST call is made once the cohort is removed
+        if cohort is not None:
+            self._clientApp.delete_multicast_group(cohort["group"][0])
+
+    async def _delayed_update(self, delay):
+        await asyncio.sleep(delay)
+        # Include the cohorts whose multicast group is still being created
+        while len(self._pending_cohorts) > 0:
+            await asyncio.sleep(config.ENROLMENT_INTERVAL)
+        await self._flush_enrolments()
+        self.update_proc()
 
     def update_proc(self):
 
-        for dict_key in self._keys_dict:
-            dev_version = dict_key.split(',')[0]
-            latest_version = dict_key.split(',')[1]
-            multicast_group_id = self._keys_dict[dict_key][0]
-            upater = updateHandler(dev_version, latest_version, self._clientApp, self._loraserver_jwt, multicast_group_id, self)
+        with self._updater_lock:
+            for dict_key in self.registry.cohorts():
+                if dict_key in self.multicast_updaters:
+                    continue
+                cohort = self.registry.get_cohort(dict_key)
+                dev_version = dict_key.split(',')[0]
+                latest_version = dict_key.split(',')[1]
+                multicast_group_id = cohort["group"][0]
+                session_id = cohort["session_id"]
+                upater = updateHandler(dev_version, latest_version, self._clientApp, self._loraserver_jwt, multicast_group_id, self, session_id)
+
+                self.multicast_updaters[upater.tag] = upater
+                self.registry.set_cohort_status(dict_key, DeviceRegistry.COHORT_UPDATING)
+                self._loop.create_task(upater.run())
+
+    def _resume_updates(self):
+        # Continue the rollouts left by a previous run of the service
+        cohorts = [self.registry.get_cohort(key) for key in self.registry.cohorts()]
+        if len(cohorts) == 0:
+            return
+
+        # Devices not yet added to their multicast group
+        with self._updater_lock:
+            for dev_eui, cohort in self.registry.devices_with_status(DeviceRegistry.STATUS_PENDING):
+                if cohort is not None:
+                    self._enrolments.setdefault(cohort, set()).add(dev_eui)
+        self._enrol_event.set()
 
-            self.multicast_updaters.append(upater)
+        self._next_update = min(cohort["update_time"] for cohort in cohorts)
+        delay = max(0, self._next_update - int(time.time()))
+        print("Resuming {} update cohorts in {} s".format(len(cohorts), delay))
+        self._update_task = self._loop.create_task(self._delayed_update(delay))
 
     def _get_update_type(self, need_updating, device_version):
         update_type = b',' + self.NO_UPDATE
@@ -257,7 +544,7 @@ class OTAHandler:
 
         return update_type
 
-    def _create_update_info_msg(self, version, device_version):
+    def _create_update_info_msg(self, version, device_version, session_id=None):
         msg = bytearray()
         msg.extend(self.MSG_HEADER)
         msg.extend(b',' + str(self.UPDATE_INFO_REPLY).encode())
@@ -270,6 +557,8 @@ class OTAHandler:
         else:
             msg.extend(b',-1')
         msg.extend(b',' + str(int(time.time())).encode())
+        if need_updating and session_id is not None:
+            msg.extend(b',' + str(session_id).encode())
         msg.extend(b',' + self.MSG_TAIL)
         return msg
 
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020, Pycom Limited.
+#
+# This software is licensed under the GNU GPL version 3 or any
+# later version, with permitted additional terms. For more information
+# see the Pycom Licence v1.0 document supplied with this file, or
+# available at https://www.pycom.io/opensource/licensing
+#
+
+from concurrent.futures import ProcessPoolExecutor, Future
+import diff_match_patch as dmp_module
+import threading
+import hashlib
+import os
+
+def make_patch(left_text, right_text, diff_timeout):
+    dmp = dmp_module.diff_match_patch()
+    dmp.Diff_Timeout = diff_timeout
+
+    patch_lst = dmp.patch_make(left_text, right_text)
+    return dmp.patch_toText(patch_lst)
+
+# Generates the file patches in a process pool and keeps them on disk, keyed by
+# the SHA1 of the original and the updated file contents and the diff timeout,
+# so every patch is computed only once for all multicast groups and across
+# restarts.
+class PatchCache:
+
+    def __init__(self, cache_dir, diff_timeout, workers=None):
+        self.cache_dir = cache_dir
+        self.diff_timeout = diff_timeout
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def stop(self):
+        self._pool.shutdown(wait=False)
+
+    def _cache_path(self, left_text, right_text):
+        left_hash = hashlib.sha1(left_text.encode()).hexdigest()
+        right_hash = hashlib.sha1(right_text.encode()).hexdigest()
+        return os.path.join(self.cache_dir, '{}_{}_{}.patch'.format(left_hash, right_hash, self.diff_timeout))
+
+    def _read(self, path):
+        try:
+            with open(path) as fh:
+                return fh.read()
+        except OSError:
+            return None
+
+    def _store(self, path, future):
+        try:
+            if future.exception() is not None:
+                print("Error creating patch: {}".format(future.exception()))
+                return
+
+            tmp_path = path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as fh:
+                    fh.write(future.result())
+                os.replace(tmp_path, path)
+            except OSError as ex:
+                print("Error storing patch: {}".format(ex))
+        finally:
+            # Requests for the patch are served by the future until the file
+            # is written
+            with self._lock:
+                del self._pending[path]
+
+    def submit(self, left_text, right_text):
+        path = self._cache_path(left_text, right_text)
+
+        with self._lock:
+            # The same patch may be requested by several groups at once
+            if path in self._pending:
+                return self._pending[path]
+
+            patch_str = self._read(path)
+            if patch_str is not None:
+                future = Future()
+                future.set_result(patch_str)
+                return future
+
+            future = self._pool.submit(make_patch, left_text, right_text, self.diff_timeout)
+            self._pending[path] = future
+
+        future.add_done_callback(lambda f: self._store(path, f))
+        return future
@@ -9,23 +9,27 @@
 #
 
 import paho.mqtt.client as paho
+from uplinkPipeline import UplinkPipeline
 from ota import OTAHandler
+import threading
 import signal
-import time
 import config
 import sys
 
-exit = False
+exit = threading.Event()
 client = None
 
 def sigint_handler(signum, frame):
-    global exit
-    exit = True
+    exit.set()
     print("Terminating Lora OTA updater")
 
-def on_message(mosq, ota, msg):
-    print("{} {} {}".format(msg.topic, msg.qos, msg.payload))
-    ota.process_rx_msg(msg.payload.decode())
+def on_connect(mosq, pipeline, flags, rc):
+    # (Re)subscribe on every connection
+    mosq.subscribe("application/+/device/+/event/up", 0)
+
+def on_message(mosq, pipeline, msg):
+    # Runs in the MQTT network thread, the uplink is processed by the pipeline
+    pipeline.submit(msg.topic, msg.payload)
 
 def on_publish(mosq, obj, mid):
     pass
@@ -34,19 +38,26 @@ if __name__ == '__main__':
     signal.signal(signal.SIGINT, sigint_handler)
 
     ota = OTAHandler()
+    pipeline = UplinkPipeline(ota, config.UPLINK_WORKERS, config.UPLINK_QUEUE_SIZE)
 
-    client = paho.Client(userdata=ota)
-    client.connect(config.LORASERVER_IP, config.LORASERVER_MQTT_PORT, 60)
-
+    client = paho.Client(userdata=pipeline)
+    client.on_connect = on_connect
     client.on_message = on_message
     client.on_publish = on_publish
 
-    client.subscribe("application/+/device/+/event/up", 0)
+    client.connect(config.LORASERVER_IP, config.LORASERVER_MQTT_PORT, 60)
 
     ota.set_mqtt_client(client)
 
-    while client.loop() == 0 and not exit:
-        pass
+    # The network thread keeps the connection alive independently of the
+    # uplink processing
+    client.loop_start()
+
+    interval = config.STATS_INTERVAL if config.STATS_INTERVAL > 0 else None
+    while not exit.wait(interval):
+        print(pipeline.report())
 
+    client.loop_stop()
+    pipeline.stop()
     ota.stop()
     sys.exit(0)
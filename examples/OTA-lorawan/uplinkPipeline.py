@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020, Pycom Limited.
+#
+# This software is licensed under the GNU GPL version 3 or any
+# later version, with permitted additional terms. For more information
+# see the Pycom Licence v1.0 document supplied with this file, or
+# available at https://www.pycom.io/opensource/licensing
+#
+
+import threading
+import queue
+import time
+import zlib
+
+# Number of uplinks and latency of one stage of the pipeline
+class StageStats:
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def report(self):
+        with self._lock:
+            avg = self.total / self.count if self.count > 0 else 0.0
+            text = "{}: {} avg {:.1f} ms max {:.1f} ms".format(self.name, self.count, avg * 1000, self.max * 1000)
+            self.reset()
+        return text
+
+# Uplink processing decoupled from the MQTT client: the MQTT callback only
+# queues the message, worker threads parse it once and hand it to the
+# OTAHandler. Messages of one device always go to the same worker so they are
+# handled in order. When a worker falls behind its bounded queue fills up and
+# further uplinks for it are dropped, the devices repeat unanswered requests.
+class UplinkPipeline:
+
+    def __init__(self, ota, workers, queue_size):
+        self.ota = ota
+        self._exit = False
+        self.dropped = 0
+
+        self.queued_stats = StageStats('queued')
+        self.parse_stats = StageStats('parse')
+        self.process_stats = StageStats('process')
+
+        self._queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for i in range(workers)]
+        self._workers = []
+        for q in self._queues:
+            th = threading.Thread(target=self._worker_proc, args=(q,))
+            th.start()
+            self._workers.append(th)
+
+    def stop(self):
+        self._exit = True
+        for q in self._queues:
+            q.put(None)
+        for th in self._workers:
+            th.join()
+
+    # Called from the MQTT network thread, must never block
+    def submit(self, topic, payload):
+        q = self._queues[zlib.crc32(topic.encode()) % len(self._queues)]
+        try:
+            q.put_nowait((time.monotonic(), payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def _worker_proc(self, q):
+        while not self._exit:
+            item = q.get()
+            if item is None:
+                break
+
+            start = time.monotonic()
+            self.queued_stats.add(start - item[0])
+
+            dev_eui, dev_msg = self.ota.parse_uplink(item[1])
+            parsed = time.monotonic()
+            self.parse_stats.add(parsed - start)
+
+            try:
+                self.ota.process_uplink(dev_eui, dev_msg)
+            except Exception as ex:
+                print("Exception processing uplink: {}".format(ex))
+            self.process_stats.add(time.monotonic() - parsed)
+
+    def report(self):
+        backlog = sum(q.qsize() for q in self._queues)
+        text = "Uplinks: backlog {}, dropped {}, {}, {}, {}".format(backlog, self.dropped, self.queued_stats.report(),
+                                                                   self.parse_stats.report(), self.process_stats.report())
+        self.dropped = 0
+        return text
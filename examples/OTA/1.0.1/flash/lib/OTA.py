@@ -14,10 +14,14 @@ import machine
 import ujson
 import uhashlib
 import ubinascii
+import ustruct
+import uzlib
 import gc
 import pycom
 import os
 import machine
+import utime
+import _thread
 
 # Try to get version number
 try:
@@ -27,6 +31,12 @@ except ImportError:
 
 
 class OTA():
+    # Progress of an interrupted update, see `update()`
+    journal_path = "/flash/OTA_JOURNAL.json"
+
+    # Release channel to request updates from, None for the latest version
+    channel = None
+
     # The following two methods need to be implemented in a subclass for the
     # specific transport mechanism e.g. WiFi
 
@@ -36,48 +46,110 @@ class OTA():
     def get_data(self, req, dest_path=None, hash=False):
         raise NotImplementedError()
 
+    # Closes any connection to the server kept open between requests
+    def close(self):
+        pass
+
+    # Returns a new instance of the transport with its own connection to the
+    # server, used to download several files at once. Transports that do not
+    # support concurrent downloads don't need to implement it.
+    def clone(self):
+        raise NotImplementedError()
+
+    # Reads `length` bytes of the firmware image the device is currently
+    # running, starting at `offset`. This is needed to apply firmware deltas
+    # and has to be implemented for the specific platform, without it the
+    # full firmware image is always downloaded.
+    def read_firmware(self, offset, length):
+        raise NotImplementedError()
+
+    # Returns True if the running firmware image can be read, deltas are only
+    # requested from the server in that case
+    def can_read_firmware(self):
+        try:
+            self.read_firmware(0, 1)
+            return True
+        except Exception:
+            return False
+
     # OTA methods
 
     def get_current_version(self):
         return VERSION
 
+    def get_device_id(self):
+        return ubinascii.hexlify(machine.unique_id()).decode()
+
     def get_update_manifest(self):
-        req = "manifest.json?current_ver={}".format(self.get_current_version())
+        req = "manifest.json?current_ver={}&device_id={}".format(
+            self.get_current_version(), self.get_device_id())
+        if self.channel is not None:
+            req += "&channel={}".format(self.channel)
+        if self.can_read_firmware():
+            req += "&delta=1"
         manifest_data = self.get_data(req).decode()
         manifest = ujson.loads(manifest_data)
         gc.collect()
         return manifest
 
-    def update(self):
+    # Performs the update. The verified files are recorded in a journal so
+    # that an update interrupted by a reset continues where it stopped.
+    # Parameters:
+    #    parallel - Number of files to download at once if the transport
+    #               supports it
+    def update(self, parallel=1):
         manifest = self.get_update_manifest()
         if manifest is None:
             print("Already on the latest version")
             return
 
-        # Download new files and verify hashes
-        for f in manifest['new'] + manifest['update']:
-            # Upto 5 retries
-            for _ in range(5):
-                try:
-                    self.get_file(f)
-                    break
-                except Exception as e:
-                    print(e)
-                    print("Error downloading `{}` retrying...".format(f['URL']))
-            else:
-                raise Exception("Failed to download `{}`".format(f['URL']))
+        # Skip the files that were downloaded and verified before a reset. Once
+        # all files are verified the journal is marked as finalizing, a reset
+        # after that resumes with the steps below, which skip the files that
+        # were already swapped.
+        journal = self.load_journal(manifest['version'])
+        if not journal.get('finalizing', False):
+            files = [f for f in manifest['new'] + manifest['update']
+                     if not self.is_journaled(journal, f)]
+
+            if parallel > 1 and len(files) > 1:
+                self.prefetch_files(files, parallel)
+
+            # Download new files and verify hashes
+            for f in files:
+                # Upto 5 retries
+                for _ in range(5):
+                    try:
+                        # Use the prefetched file if it is intact
+                        if not self.verify_file(f):
+                            self.get_file(f)
+                        journal['files'][f['dst_path']] = f['hash']
+                        self.save_journal(journal)
+                        break
+                    except Exception as e:
+                        print(e)
+                        print("Error downloading `{}` retrying...".format(f['URL']))
+                else:
+                    raise Exception("Failed to download `{}`".format(f['URL']))
+
+            journal['finalizing'] = True
+            self.save_journal(journal)
 
         # Backup old files
         # only once all files have been successfully downloaded
         for f in manifest['update']:
-            self.backup_file(f)
+            # Skip the files backed up or replaced before a reset
+            if self.file_exists(f['dst_path']) and \
+               self.file_exists("{}.new".format(f['dst_path'])):
+                self.backup_file(f)
 
         # Rename new files to proper name
         for f in manifest['new'] + manifest['update']:
             new_path = "{}.new".format(f['dst_path'])
             dest_path = "{}".format(f['dst_path'])
 
-            os.rename(new_path, dest_path)
+            if self.file_exists(new_path):
+                os.rename(new_path, dest_path)
 
         # `Delete` files no longer required
         # This actually makes a backup of the files incase we need to roll back
@@ -85,8 +157,11 @@ class OTA():
             self.delete_file(f)
 
         # Flash firmware
-        if "firmware" in manifest:
+        if "firmware" in manifest and not journal.get('firmware', False):
             self.write_firmware(manifest['firmware'])
+            journal['firmware'] = True
+            self.save_journal(journal)
+        self.close()
 
         # Save version number
         try:
@@ -97,9 +172,120 @@ class OTA():
             fp.write("VERSION = '{}'".format(manifest['version']))
         from OTA_VERSION import VERSION
 
+        # The update is complete, there is nothing left to resume
+        try:
+            os.remove(self.journal_path)
+        except OSError:
+            pass
+
         # Reboot the device to run the new decode
         machine.reset()
 
+    def load_journal(self, version):
+        try:
+            with open(self.journal_path, 'r') as fp:
+                journal = ujson.loads(fp.read())
+            # A journal of an update to a different version is of no use
+            if journal['version'] == version:
+                return journal
+        except Exception:
+            pass  # There is no journal or it is corrupt
+        return {'version': version, 'files': {}}
+
+    def save_journal(self, journal):
+        with open(self.journal_path, 'w') as fp:
+            fp.write(ujson.dumps(journal))
+
+    def is_journaled(self, journal, f):
+        if journal['files'].get(f['dst_path']) != f['hash']:
+            return False
+        # The file is gone, download it again
+        return self.file_exists("{}.new".format(f['dst_path']))
+
+    def file_exists(self, path):
+        try:
+            os.stat(path)
+            return True
+        except OSError:
+            return False
+
+    def prefetch_files(self, files, parallel):
+        # Downloads the files to their .new paths using up to `parallel`
+        # connections. Nothing is hashed here since only one hash operation
+        # is allowed at once, the files are verified by `verify_file()`.
+        try:
+            transports = [self.clone() for _ in range(parallel)]
+        except NotImplementedError:
+            return  # The transport does not support concurrent downloads
+
+        queue = list(files)
+        lock = _thread.allocate_lock()
+        running = [len(transports)]
+        for transport in transports:
+            _thread.start_new_thread(self._prefetch_worker,
+                                     (transport, queue, lock, running))
+
+        while running[0] > 0:
+            utime.sleep_ms(100)
+
+    def _prefetch_worker(self, transport, queue, lock, running):
+        try:
+            while True:
+                with lock:
+                    if len(queue) == 0:
+                        break
+                    f = queue.pop()
+
+                new_path = "{}.new".format(f['dst_path'])
+                try:
+                    if 'compressed' in f:
+                        transport.get_data(
+                            f['compressed']['URL'].split("/", 3)[-1],
+                            dest_path="{}.z".format(new_path))
+                    else:
+                        transport.get_data(f['URL'].split("/", 3)[-1],
+                                           dest_path=new_path)
+                except Exception as e:
+                    # The file is downloaded again by `update()`
+                    print("Error prefetching `{}`: {}".format(f['URL'], e))
+        finally:
+            transport.close()
+            with lock:
+                running[0] -= 1
+
+    def verify_file(self, f):
+        # Returns True if a previously downloaded .new file (or its compressed
+        # form) matches the expected hash
+        new_path = "{}.new".format(f['dst_path'])
+        try:
+            if 'compressed' in f:
+                z_path = "{}.z".format(new_path)
+                os.stat(z_path)
+                try:
+                    hash = self.decompress_file(z_path, new_path,
+                                                f['compressed']['wbits'])
+                finally:
+                    os.remove(z_path)
+            else:
+                hash = self.hash_file(new_path)
+        except Exception:
+            return False  # There is no (valid) prefetched file
+        return hash == f['hash']
+
+    def hash_file(self, path, block_size=512):
+        h = uhashlib.sha1()
+        try:
+            with open(path, 'rb') as fp:
+                block = fp.read(block_size)
+                while block:
+                    h.update(block)
+                    block = fp.read(block_size)
+        except Exception as e:
+            # Only one hash operation is allowed at once
+            h.digest()
+            raise e
+        return ubinascii.hexlify(h.digest()).decode()
+
     def get_file(self, f):
         new_path = "{}.new".format(f['dst_path'])
 
@@ -111,9 +297,12 @@ class OTA():
 
         # Download new file with a .new extension to not overwrite the existing
         # file until the hash is verified.
-        hash = self.get_data(f['URL'].split("/", 3)[-1],
-                             dest_path=new_path,
-                             hash=True)
+        if 'compressed' in f:
+            hash = self.get_compressed_file(f['compressed'], new_path)
+        else:
+            hash = self.get_data(f['URL'].split("/", 3)[-1],
+                                 dest_path=new_path,
+                                 hash=True)
 
         # Hash mismatch
         if hash != f['hash']:
@@ -121,6 +310,37 @@ class OTA():
             msg = "Downloaded file's hash does not match expected hash"
             raise Exception(msg)
 
+    def get_compressed_file(self, f, dest_path):
+        z_path = "{}.z".format(dest_path)
+        try:
+            self.get_data(f['URL'].split("/", 3)[-1], dest_path=z_path)
+            return self.decompress_file(z_path, dest_path, f['wbits'])
+        finally:
+            try:
+                os.remove(z_path)
+            except OSError:
+                pass  # The file was never downloaded
+
+    def decompress_file(self, z_path, dest_path, wbits, block_size=512):
+        # Decompress into the destination file while hashing the decompressed
+        # content
+        h = uhashlib.sha1()
+        try:
+            with open(z_path, 'rb') as zp:
+                d = uzlib.DecompIO(zp, wbits)
+                with open(dest_path, 'wb') as fp:
+                    block = d.read(block_size)
+                    while block:
+                        h.update(block)
+                        fp.write(block)
+                        block = d.read(block_size)
+        except Exception as e:
+            # Only one hash operation is allowed at once
+            h.digest()
+            raise e
+
+        return ubinascii.hexlify(h.digest()).decode()
+
     def backup_file(self, f):
         bak_path = "{}.bak".format(f['dst_path'])
         dest_path = "{}".format(f['dst_path'])
@@ -138,6 +358,10 @@ class OTA():
         bak_path = "/{}.bak_del".format(f)
         dest_path = "/{}".format(f)
 
+        # Already deleted before a reset
+        if not self.file_exists(dest_path):
+            return
+
         # Delete previous delete backup if it exists
         try:
             os.remove(bak_path)
@@ -148,18 +372,124 @@ class OTA():
         os.rename(dest_path, bak_path)
 
     def write_firmware(self, f):
+        if 'delta' in f:
+            try:
+                self.write_firmware_delta(f['delta'])
+                return
+            except Exception as e:
+                print(e)
+                print("Failed to apply firmware delta, downloading full image")
+
         hash = self.get_data(f['URL'].split("/", 3)[-1],
                              hash=True,
                              firmware=True)
         # TODO: Add verification when released in future firmware
 
+    def write_firmware_delta(self, f):
+        # Fail before downloading anything if the current image can't be read
+        self.read_firmware(0, 1)
+
+        delta_path = "/flash/firmware.delta"
+        try:
+            hash = self.get_data(f['URL'].split("/", 3)[-1],
+                                 dest_path=delta_path,
+                                 hash=True)
+            if hash != f['hash']:
+                msg = "Downloaded delta's hash does not match expected hash"
+                raise Exception(msg)
+
+            with open(delta_path, 'rb') as fp:
+                self.apply_firmware_delta(fp, f['dst_hash'])
+        finally:
+            try:
+                os.remove(delta_path)
+            except OSError:
+                pass  # The delta was never downloaded
+
+    def apply_firmware_delta(self, fp, dst_hash, block_size=4096):
+        # See the description of the delta format in OTA_server.py
+        if fp.read(4) != b'OTAD':
+            raise Exception("Invalid firmware delta")
+        size = ustruct.unpack('>I', fp.read(4))[0]
+
+        h = uhashlib.sha1()
+        written = 0
+        pycom.ota_start()
+        try:
+            op = fp.read(1)
+            while op:
+                if op == b'\x01':
+                    offset, length = ustruct.unpack('>II', fp.read(8))
+                    while length > 0:
+                        block = self.read_firmware(offset,
+                                                   min(length, block_size))
+                        offset += len(block)
+                        length -= len(block)
+                        written += len(block)
+                        h.update(block)
+                        pycom.ota_write(block)
+                elif op == b'\x02':
+                    length = ustruct.unpack('>I', fp.read(4))[0]
+                    while length > 0:
+                        block = fp.read(min(length, block_size))
+                        if not block:
+                            raise Exception("Truncated firmware delta")
+                        length -= len(block)
+                        written += len(block)
+                        h.update(block)
+                        pycom.ota_write(block)
+                else:
+                    raise Exception("Invalid firmware delta operation")
+                op = fp.read(1)
+        except Exception as e:
+            # Only one hash operation is allowed at once
+            h.digest()
+            raise e
+
+        hash = ubinascii.hexlify(h.digest()).decode()
+        if written != size or hash != dst_hash:
+            # The update partition is not activated without ota_finish()
+            raise Exception("Patched firmware does not match expected hash")
+        pycom.ota_finish()
+
 
 class WiFiOTA(OTA):
+    # Size of the receive buffer, allocated once and reused for every request
+    BUFFER_SIZE = 1024
+
+    # Maximum size of the HTTP headers of a response
+    MAX_HEADER_SIZE = 2048
+
+    # Size of the blocks of the flash partitions
+    FLASH_BLOCK_SIZE = 4096
+
     def __init__(self, ssid, password, ip, port):
         self.SSID = ssid
         self.password = password
         self.ip = ip
         self.port = port
+        self.sock = None
+        self.buf = bytearray(self.BUFFER_SIZE)
+        self.mv = memoryview(self.buf)
+        self.partition = None
+
+    def clone(self):
+        return WiFiOTA(self.SSID, self.password, self.ip, self.port)
+
+    def read_firmware(self, offset, length):
+        # The running partition is read through the esp32 module, firmware
+        # without it always downloads the full image
+        if self.partition is None:
+            try:
+                import esp32
+                self.partition = esp32.Partition(esp32.Partition.RUNNING)
+            except (ImportError, AttributeError):
+                raise NotImplementedError()
+
+        block = bytearray(length)
+        self.partition.readblocks(offset // self.FLASH_BLOCK_SIZE, block,
+                                  offset % self.FLASH_BLOCK_SIZE)
+        return bytes(block)
 
     def connect(self):
         self.wlan = network.WLAN(mode=network.WLAN.STA)
@@ -178,22 +508,83 @@ class WiFiOTA(OTA):
             pass
 
     def _http_get(self, path, host):
-        req_fmt = 'GET /{} HTTP/1.0\r\nHost: {}\r\n\r\n'
+        req_fmt = 'GET /{} HTTP/1.1\r\nHost: {}\r\n\r\n'
         req = bytes(req_fmt.format(path, host), 'utf8')
         return req
 
-    def get_data(self, req, dest_path=None, hash=False, firmware=False):
-        # Connect to server
-        print("Requesting: {}".format(req))
-        s = socket.socket(socket.AF_INET,
-                          socket.SOCK_STREAM,
-                          socket.IPPROTO_TCP)
-        s.connect((self.ip, self.port))
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _get_socket(self):
+        # Reuse the connection of the previous request if it is still open
+        if self.sock is None:
+            s = socket.socket(socket.AF_INET,
+                              socket.SOCK_STREAM,
+                              socket.IPPROTO_TCP)
+            s.connect((self.ip, self.port))
+            self.sock = s
+        return self.sock
+
+    def _read_headers(self, s):
+        # Returns the status code, the headers (with lower case names) and
+        # any part of the body that was received along with the headers
+        data = b''
+        end = -1
+        while end < 0:
+            result = s.recv(self.BUFFER_SIZE)
+            if len(result) == 0:
+                raise Exception("Connection closed by server")
+            # The separator can be split across two chunks
+            start = max(len(data) - 3, 0)
+            data += result
+            end = data.find(b'\r\n\r\n', start)
+            if end < 0 and len(data) > self.MAX_HEADER_SIZE:
+                raise Exception("HTTP headers too large")
+
+        lines = data[:end].decode().split('\r\n')
+        status = int(lines[0].split(' ')[1])
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        return status, headers, data[end + 4:]
+
+    def _send_request(self, req):
+        reused = self.sock is not None
+        try:
+            s = self._get_socket()
+            s.sendall(self._http_get(req, "{}:{}".format(self.ip, self.port)))
+            return self._read_headers(s)
+        except Exception as e:
+            self.close()
+            if not reused:
+                raise e
 
-        # Request File
+        # The server closed the idle connection, retry on a new one
+        s = self._get_socket()
         s.sendall(self._http_get(req, "{}:{}".format(self.ip, self.port)))
+        return self._read_headers(s)
+
+    def get_data(self, req, dest_path=None, hash=False, firmware=False):
+        h = None
+
+        # Request File, the connection to the server is kept open between
+        # requests
+        print("Requesting: {}".format(req))
+        status, headers, result = self._send_request(req)
 
         try:
+            if status != 200:
+                raise Exception("HTTP error {} for `{}`".format(status, req))
+
+            # Without a Content-Length the body ends when the server closes
+            # the connection
+            remaining = int(headers.get('content-length', -1))
+            keep_alive = remaining >= 0 and \
+                headers.get('connection', '').lower() != 'close'
+
             content = bytearray()
             fp = None
             if dest_path is not None:
@@ -204,33 +595,49 @@ class WiFiOTA(OTA):
             if firmware:
                 pycom.ota_start()
 
-            h = uhashlib.sha1()
-
-            # Get data from server
-            result = s.recv(100)
-
-            start_writing = False
-            while (len(result) > 0):
-                # Ignore the HTTP headers
-                if not start_writing:
-                    if "\r\n\r\n" in result:
-                        start_writing = True
-                        result = result.decode().split("\r\n\r\n")[1].encode()
-
-                if start_writing:
+            if hash:
+                h = uhashlib.sha1()
+
+            # Part of the body might have been received with the headers
+            n = len(result)
+            if remaining >= 0:
+                n = min(n, remaining)
+            data = result[:n]
+
+            # Get data from server, reading into the preallocated buffer. Only
+            # as much as is left of the body is requested so the next
+            # response on the connection is never consumed.
+            s = self.sock
+            while True:
+                if n > 0:
                     if firmware:
-                        pycom.ota_write(result)
+                        pycom.ota_write(data)
                     elif fp is None:
-                        content.extend(result)
+                        content.extend(data)
                     else:
-                        fp.write(result)
+                        fp.write(data)
 
                     if hash:
-                        h.update(result)
+                        h.update(data)
 
-                result = s.recv(100)
+                    if remaining > 0:
+                        remaining -= n
 
-            s.close()
+                if remaining == 0:
+                    break
+
+                size = self.BUFFER_SIZE
+                if remaining > 0:
+                    size = min(size, remaining)
+                n = s.readinto(self.buf, size)
+                if not n:
+                    if remaining > 0:
+                        raise Exception("Connection closed by server")
+                    break
+                data = self.mv[:n]
+
+            if not keep_alive:
+                self.close()
 
             if fp is not None:
                 fp.close()
@@ -238,18 +645,18 @@ class WiFiOTA(OTA):
                 pycom.ota_finish()
 
         except Exception as e:
+            # The state of the connection is unknown, don't reuse it
+            self.close()
             # Since only one hash operation is allowed at Once
             # ensure we close it if there is an error
             if h is not None:
                 h.digest()
             raise e
 
-        hash_val = ubinascii.hexlify(h.digest()).decode()
-
         if dest_path is None:
             if hash:
-                return (bytes(content), hash_val)
+                return (bytes(content), ubinascii.hexlify(h.digest()).decode())
             else:
                 return bytes(content)
         elif hash:
-            return hash_val
+            return ubinascii.hexlify(h.digest()).decode()
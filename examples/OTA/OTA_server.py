@@ -82,7 +82,13 @@
 #    ],
 #    "firmware": {
 #        "URL": "http://192.168.1.144:8000/firmware_1.0.1b.bin",
-#        "hash": "ccc6914a457eb4af8855ec02f6909316526bdd08"
+#        "hash": "ccc6914a457eb4af8855ec02f6909316526bdd08",
+#        "delta": {
+#            "URL": "http://192.168.1.144:8000/.ota_cache/3f2a..._ccc6....delta",
+#            "hash": "5b1d3a1ee0ab7e3eb8ea1a8e1ffb3a0c2c5ad5c1",
+#            "src_hash": "3f2a8d1e3c4b8d5e7f9a0b1c2d3e4f5a6b7c8d9e",
+#            "dst_hash": "ccc6914a457eb4af8855ec02f6909316526bdd08"
+#        }
 #    },
 #    "new": [
 #        {
@@ -95,7 +101,13 @@
 #        {
 #            "URL": "http://192.168.1.144:8000/1.0.1b/flash/changed_file.py",
 #            "dst_path": "flash/changed_file.py",
-#            "hash": "1095df8213aac2983efd68dba9420c8efc9c7c4a"
+#            "hash": "1095df8213aac2983efd68dba9420c8efc9c7c4a",
+#            "compressed": {
+#                "URL": "http://192.168.1.144:8000/.ota_cache/1095df8213aac2983efd68dba9420c8efc9c7c4a.z",
+#                "hash": "0b5b2bf6b3cd8e5a6de7c8c44d69d1a6f1a4e0a3",
+#                "size": 1432,
+#                "wbits": 10
+#            }
 #        }
 #    ],
 #    "version": "1.0.1b"
@@ -103,38 +115,183 @@
 #
 # The manifest contains the following feilds:
 #  "delete": A list of paths to files which are no longer needed
-#  "firmware": The URL and SHA1 hash of the firmware image
+#  "firmware": The URL and SHA1 hash of the firmware image. If the firmware
+#              image of the client's current version is available and the
+#              client sent "delta=1" (it can read its running image), "delta"
+#              contains the URL and SHA1 hash of a binary patch that turns it
+#              ("src_hash") into the new image ("dst_hash").
 #  "new": the URL, path on end device and SHA1 hash of all new files
 #  "update": the URL, path on end device and SHA1 hash of all files which
 #            existed before but have changed.
+#  "compressed": Part of "new" and "update" entries if compressing the file
+#                makes it smaller. The URL, SHA1 hash and size of a zlib
+#                stream of the file, "wbits" is the window size it was
+#                compressed with and needs to be passed to the decompressor.
 #  "version": The version number that this manifest will update the client to
 #  "previous_version": The version the client is currently on before appling
 #                      this update
 #
+# Compressed files and firmware deltas are generated once and stored in the
+# ".ota_cache" directory. Compressed files are named after the SHA1 hash of
+# their uncompressed content so they are shared by all versions. The deltas
+# from every older firmware image to the newest one are generated in the
+# background when the server starts or a new image is added, until a delta is
+# ready the manifests contain only the full image. A delta is a sequence of
+# the following operations, with all integers stored as unsigned 32 bit big
+# endian values:
+#    header: "OTAD", size of the new image
+#    0x01 (copy): offset, length - copy a block of the current image
+#    0x02 (data): length, bytes - insert literal bytes
+#
 # Note: The version number of the files might not be the same as the firmware.
 #       The highest available version number, higher than the current client
 #       version is used for both firmware and files. This may differ between
 #       the two.
 #
+# Release channels and pinning
+# ----------------------------
+# By default every client is updated to the latest version. Clients can be
+# given a different target version by placing a "channels.json" file in the
+# server directory:
+#
+# {
+#     "channels": {
+#         "stable": "1.0.0",
+#         "beta": {"version": "1.0.1", "firmware": "1.0.1"}
+#     },
+#     "pins": {
+#         "240ac4fffe0bf998": "1.0.0"
+#     }
+# }
+#
+# A client selects a channel with the "channel" query parameter and identifies
+# itself with "device_id", e.g:
+#    http://127.0.0.1:8000/manifest.json?current_ver=1.0.0&channel=beta&device_id=240ac4fffe0bf998
+# A pin for the device takes precedence over its channel, unknown channels get
+# the latest version. A target is either the name of a version directory or an
+# object with the version directory ("version") and the version of the
+# firmware image ("firmware"). By default the newest firmware image is used.
+#
+# The available versions are kept in an in-memory catalogue which is refreshed
+# when the content of the server directory or the channels file changes
+# (checked every CATALOGUE_POLL_INTERVAL seconds).
+#
 # In order for the URL's to be properly formatted you are required to send a
 # "host" header along with your HTTP get request e.g:
 # GET /manifest.json?current_ver=1.0.0 HTTP/1.0\r\nHost: 192.168.1.144:8000\r\n\r\n
+#
+# Update files and firmware images are streamed from disk (using sendfile where
+# the OS supports it) with a Content-Length and an ETag (the SHA1 hash of the
+# file). Single byte ranges are supported through the "Range" header so a
+# client that lost its connection part way through a download can resume it,
+# e.g:
+# GET /firmware_1.0.1.bin HTTP/1.0\r\nRange: bytes=524288-\r\n\r\n
+#
+# The server speaks HTTP/1.1, a client can download the manifest and all files
+# over a single connection and send its requests without waiting for the
+# previous response (pipelining), they are answered in order.
+#
+# Every client connection is handled in its own thread, so a slow device does
+# not hold up the rest of the fleet. The number of file downloads that are
+# served at the same time is limited by MAX_CONCURRENT_DOWNLOADS, further
+# downloads wait up to DOWNLOAD_QUEUE_TIMEOUT seconds for a free slot before
+# being answered with "503 Service Unavailable". CLIENT_BANDWIDTH limits the
+# rate at which each download is sent and REQUEST_QUEUE_SIZE sets the number of
+# connections the OS queues before they are accepted.
 
 import os
 import socket
 import json
 import hashlib
-import filecmp
 import re
+import time
+import zlib
+import functools
+import struct
+import threading
+import collections
+import queue
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
 from distutils.version import LooseVersion
 
 PORT = 8000
 
+# Minimum number of seconds between two checks of a version directory for
+# modifications. Manifests requested within this window are served straight
+# from the manifest cache.
+INDEX_CHECK_INTERVAL = 5
+
+# Maximum number of version directories whose content index is kept in memory
+VERSION_INDEX_CACHE_SIZE = 64
+
+# Maximum number of generated manifests kept in memory
+MANIFEST_CACHE_SIZE = 256
+
+# Maximum number of file hashes kept in memory
+HASH_CACHE_SIZE = 4096
+
+# Size of the blocks used when reading files for hashing
+HASH_BLOCK_SIZE = 64 * 1024
+
+# Maximum number of file downloads served at the same time
+MAX_CONCURRENT_DOWNLOADS = 64
+
+# Number of seconds a download waits for a free slot before it is rejected
+DOWNLOAD_QUEUE_TIMEOUT = 30
+
+# Maximum rate in bytes per second at which a single download is sent, 0 for
+# unlimited
+CLIENT_BANDWIDTH = 0
+
+# Size of the chunks sent at once when CLIENT_BANDWIDTH is set
+SEND_CHUNK_SIZE = 16 * 1024
+
+# Number of pending connections queued by the OS before they are accepted
+REQUEST_QUEUE_SIZE = 128
+
+# Seconds of inactivity after which a client connection is dropped
+CLIENT_TIMEOUT = 60
+
+# Name of the file defining release channels and version pins
+CHANNELS_FILE = 'channels.json'
+
+# Number of seconds between checks of the server directory for new versions
+CATALOGUE_POLL_INTERVAL = 2
+
+# Directory in which generated files (e.g. firmware deltas) are stored
+CACHE_DIR = '.ota_cache'
+
+# Window size (log2) used to compress update files. The client needs a buffer
+# of this size to decompress them, so it is kept small.
+COMPRESS_WBITS = 10
+
+# Size of the blocks of the old firmware image that are matched against the
+# new image when generating a delta
+DELTA_BLOCK_SIZE = 32
+
+
+# Threaded HTTP server that limits the number of concurrent downloads and
+# the bandwidth of each download.
+class OTAServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, handler,
+                 max_downloads=MAX_CONCURRENT_DOWNLOADS,
+                 client_bandwidth=CLIENT_BANDWIDTH,
+                 request_queue_size=REQUEST_QUEUE_SIZE):
+        self.request_queue_size = request_queue_size
+        self.download_slots = threading.BoundedSemaphore(max_downloads)
+        self.client_bandwidth = client_bandwidth
+        super().__init__(server_address, handler)
+
 
 class OTAHandler(BaseHTTPRequestHandler):
+    # Every response has a Content-Length, so connections are kept open for
+    # further (pipelined) requests
+    protocol_version = 'HTTP/1.1'
+    timeout = CLIENT_TIMEOUT
 
     def do_GET(self):
         print("Got query for: {}".format(self.path))
@@ -146,10 +303,6 @@ class OTAHandler(BaseHTTPRequestHandler):
 
         # Generate update manifest
         if path == "/manifest.json":
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-
             # If query specified a version generate a diff from that version
             # otherwise return a manifest of all files
             if "current_ver" in query_components:
@@ -157,40 +310,308 @@ class OTAHandler(BaseHTTPRequestHandler):
             else:
                 # This assumes there is no version lower than 0
                 current_ver = '0'
+            channel = query_components.get("channel", [None])[0]
+            device_id = query_components.get("device_id", [None])[0]
+            delta = query_components.get("delta", ["0"])[0] == "1"
 
             # Send manifest
             print("Generating a manifest from version: {}".format(current_ver))
-            manifest = generate_manifest(current_ver, host)
-            j = json.dumps(manifest,
-                           sort_keys=True,
-                           indent=4,
-                           separators=(',', ': '))
-            self.wfile.write(j.encode())
+            manifest = get_manifest_json(current_ver, host, channel, device_id,
+                                         delta)
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(manifest)))
+            self.end_headers()
+            self.wfile.write(manifest)
 
         # Send file
         else:
+            self.send_file(path)
+
+    # Streams the file at `path` (relative to the server directory) to the
+    # client, honouring "Range" and "If-None-Match" request headers.
+    def send_file(self, path):
+        file_path = os.path.normpath(unquote(path)).lstrip(os.path.sep)
+        if file_path.startswith('..'):
+            self.send_error(403, "Forbidden {}".format(self.path))
+            return
+
+        try:
+            f = open(os.path.join('.', file_path), 'rb')
+        # File could not be opened, send error
+        except IOError as e:
+            self.send_error(404, "File Not Found {}".format(self.path))
+            return
+
+        with f:
+            if not self.server.download_slots.acquire(
+                    timeout=DOWNLOAD_QUEUE_TIMEOUT):
+                self.send_response(503)
+                self.send_header('Retry-After', str(DOWNLOAD_QUEUE_TIMEOUT))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
             try:
-                with open(os.path.join('.', self.path[1:]), 'rb') as f:
-                    self.send_response(200)
-                    self.send_header('Content-type',
-                                     'application/octet-stream')
-                    self.end_headers()
-                    self.wfile.write(f.read())
-            # File could not be opened, send error
-            except IOError as e:
-                self.send_error(404, "File Not Found {}".format(self.path))
-
-
-# Searches the current working directory for the directory named with the
-# highest version number as per LooseVersion.
-def get_latest_version():
-    latest = None
-    for d in os.listdir('.'):
-        if os.path.isfile(d):
-            continue
-        if latest is None or LooseVersion(latest) < LooseVersion(d):
-            latest = d
-    return latest
+                self._send_file_content(f, file_path)
+            finally:
+                self.server.download_slots.release()
+
+    def _send_file_content(self, f, file_path):
+        size = os.fstat(f.fileno()).st_size
+        etag = '"{}"'.format(get_file_hash(os.path.join('.', file_path)))
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start, length = 0, size
+        status = 200
+        range_header = self.headers.get('Range')
+        # A range is only valid against the version of the file the client
+        # started downloading, if given
+        if range_header is not None and \
+           self.headers.get('If-Range', etag) == etag:
+            byte_range = parse_range(range_header, size)
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, length = byte_range
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                             start, start + length - 1, size))
+        self.end_headers()
+
+        # The headers are written unbuffered, so the body can be sent
+        # straight from the file to the socket
+        if length > 0:
+            self.copy_file(f, start, length)
+
+    # Sends `length` bytes of `f` starting at `offset` to the client, limited
+    # to the bandwidth configured on the server.
+    def copy_file(self, f, offset, length):
+        rate = self.server.client_bandwidth
+        if rate <= 0:
+            self.connection.sendfile(f, offset, length)
+            return
+
+        start_time = time.monotonic()
+        sent = 0
+        while sent < length:
+            count = min(SEND_CHUNK_SIZE, length - sent)
+            count = self.connection.sendfile(f, offset + sent, count)
+            if count == 0:
+                break  # The file was truncated while sending
+            sent += count
+            delay = start_time + sent / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+# Parses the value of a HTTP "Range" header. Only a single byte range is
+# supported. Returns a tuple of the offset and length of the requested range,
+# or None if the range cannot be satisfied.
+# Parameters
+#    header - The value of the "Range" header
+#    size - The size of the requested file
+def parse_range(header, size):
+    m = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if m is None or m.group(1) == m.group(2) == '':
+        return None
+
+    if m.group(1) == '':
+        # Suffix range, the last N bytes of the file
+        start = max(size - int(m.group(2)), 0)
+        end = size - 1
+    else:
+        start = int(m.group(1))
+        end = size - 1 if m.group(2) == '' else min(int(m.group(2)), size - 1)
+
+    if start >= size or start > end:
+        return None
+    return (start, end - start + 1)
+
+
+# Returns True if version `a` is lower than version `b` as per LooseVersion.
+# The results are cached as the same versions are compared on every request.
+@functools.lru_cache(maxsize=4096)
+def is_older(a, b):
+    try:
+        return LooseVersion(a) < LooseVersion(b)
+    except TypeError:
+        # Versions with a mix of numbers and letters at the same position
+        return str(LooseVersion(a)) < str(LooseVersion(b))
+
+
+# In-memory catalogue of the versions available on the server. Contains the
+# version directories, the firmware images and the targets of the release
+# channels and version pins read from CHANNELS_FILE, so that the target of a
+# client can be resolved without touching the file system. `refresh()` scans
+# the directory again, but only if its modification time or the one of the
+# channels file changed.
+class VersionCatalogue:
+
+    def __init__(self, path='.'):
+        self.path = path
+        # Tuple of (latest version, firmware images by version, newest
+        # firmware version, channels, pins, version directories), replaced as
+        # a whole on refresh
+        self._state = (None, {}, None, {}, {}, frozenset())
+        self._signature = None
+        self._lock = threading.Lock()
+        self._th = None
+        self.refresh()
+
+    def _get_signature(self):
+        signature = [os.stat(self.path).st_mtime_ns]
+        try:
+            channels_path = os.path.join(self.path, CHANNELS_FILE)
+            signature.append(os.stat(channels_path).st_mtime_ns)
+        except OSError:
+            signature.append(None)  # There is no channels file
+        return signature
+
+    def _load_channels(self, versions, firmware):
+        try:
+            with open(os.path.join(self.path, CHANNELS_FILE)) as f:
+                config = json.load(f)
+        except OSError:
+            return {}, {}  # There is no channels file
+        except ValueError as e:
+            print("Error reading {}: {}".format(CHANNELS_FILE, e))
+            return {}, {}
+
+        # Targets are stored as (version, firmware version) tuples
+        targets = []
+        for key in ('channels', 'pins'):
+            resolved = {}
+            for name, target in config.get(key, {}).items():
+                if not isinstance(target, dict):
+                    target = {"version": target}
+                version = target.get("version")
+                if version not in versions:
+                    print("Ignoring {} `{}`: version `{}` does not exist"
+                          .format(key[:-1], name, version))
+                    continue
+                fw_version = target.get("firmware")
+                if fw_version is not None and fw_version not in firmware:
+                    print("Ignoring {} `{}`: firmware `{}` does not exist"
+                          .format(key[:-1], name, fw_version))
+                    continue
+                resolved[name] = (version, fw_version)
+            targets.append(resolved)
+        return targets[0], targets[1]
+
+    def refresh(self):
+        with self._lock:
+            signature = self._get_signature()
+            if signature == self._signature:
+                return False
+
+            versions = set()
+            firmware = {}
+            for name in os.listdir(self.path):
+                # Ignore hidden entries (e.g. the cache directory)
+                if name.startswith('.'):
+                    continue
+                if os.path.isdir(os.path.join(self.path, name)):
+                    # Only names starting with a number are versions
+                    if re.match(r'[0-9]', name):
+                        versions.add(name)
+                else:
+                    m = re.match(r'firmware_([0-9a-zA-Z.]+)\.(bin|hex)$', name)
+                    if m is not None:
+                        firmware[m.group(1)] = name
+
+            latest = None
+            for version in versions:
+                if latest is None or is_older(latest, version):
+                    latest = version
+            newest_firmware = None
+            for version in firmware:
+                if newest_firmware is None or \
+                   is_older(newest_firmware, version):
+                    newest_firmware = version
+
+            channels, pins = self._load_channels(versions, firmware)
+            self._state = (latest, firmware, newest_firmware, channels, pins,
+                           frozenset(versions))
+            self._signature = signature
+            return True
+
+    # Starts a thread that refreshes the catalogue periodically, calling
+    # `on_change` whenever its content changed
+    def start(self, interval=CATALOGUE_POLL_INTERVAL, on_change=None):
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.refresh() and on_change is not None:
+                        on_change()
+                except OSError as e:
+                    print("Error refreshing version catalogue: {}".format(e))
+
+        self._th = threading.Thread(target=watch, daemon=True)
+        self._th.start()
+
+    # Returns the highest version available on the server
+    def get_latest_version(self):
+        return self._state[0]
+
+    # Returns True if there is a version directory named `version`
+    def has_version(self, version):
+        return version in self._state[5]
+
+    # Returns the name of the firmware image of `version` or None if there is
+    # none
+    def get_firmware(self, version):
+        return self._state[1].get(version)
+
+    # Returns the names of all firmware images
+    def get_firmware_images(self):
+        return list(self._state[1].values())
+
+    # Returns the version the client should be updated to and the name of the
+    # firmware image to be installed, or None if there is no firmware image
+    # newer than `current_ver`.
+    # Parameters
+    #    current_ver - The version the client is currently on
+    #    channel - The release channel of the client or None
+    #    device_id - The identifier of the client or None
+    def resolve(self, current_ver, channel=None, device_id=None):
+        latest, firmware, newest_firmware, channels, pins, _ = self._state
+        target = pins.get(device_id) or channels.get(channel) or (None, None)
+        version = target[0] or latest
+        fw_version = target[1] or newest_firmware
+        if fw_version is None or not is_older(current_ver, fw_version):
+            return version, None
+        return version, firmware[fw_version]
+
+
+_catalogue = None
+_catalogue_lock = threading.Lock()
+
+
+# Returns the version catalogue of the server directory, creating it and
+# starting its watcher on first use
+def get_catalogue():
+    global _catalogue
+    with _catalogue_lock:
+        if _catalogue is None:
+            _catalogue = VersionCatalogue('.')
+            _catalogue.start(on_change=precompute_firmware_deltas)
+    return _catalogue
 
 
 # Returns a list of all files found relative to `path`.
@@ -209,68 +630,354 @@ def get_all_paths(path, ignore=[]):
     return set(out)
 
 
+# Returns the signature used to detect that a file has been modified since it
+# was last hashed.
+# Parameters:
+#   path - The path of the file
+def get_file_signature(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+# Cache of file hashes keyed by path, least recently used first. Each entry
+# is a tuple of the file signature at the time it was hashed and the SHA1 hex
+# digest.
+_hash_cache = collections.OrderedDict()
+_hash_lock = threading.Lock()
+
+
+# Returns the SHA1 hex digest of a file. The hash is only computed again if
+# the inode, size or modification time of the file changed.
+# Parameters:
+#   path - The path of the file to hash
+def get_file_hash(path):
+    signature = get_file_signature(path)
+    with _hash_lock:
+        cached = _hash_cache.get(path)
+        if cached is not None and cached[0] == signature:
+            _hash_cache.move_to_end(path)
+            return cached[1]
+
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
+    digest = hasher.hexdigest()
+    with _hash_lock:
+        _hash_cache[path] = (signature, digest)
+        _hash_cache.move_to_end(path)
+        if len(_hash_cache) > HASH_CACHE_SIZE:
+            _hash_cache.popitem(last=False)
+    return digest
+
+
+# Content index of a single version directory. Maps the path of every file
+# (relative to the version directory) to its SHA1 hash. `generation` is
+# incremented every time the content of the directory changes so that
+# anything derived from the index can be invalidated.
+class VersionIndex:
+
+    def __init__(self, version, ignore=['.DS_Store', 'pymakr.conf']):
+        self.version = version
+        self.ignore = ignore
+        self.hashes = {}
+        self.generation = 0
+        self._signature = None
+        self._last_check = None
+        self._lock = threading.Lock()
+
+    # Re-scans the version directory if it has not been checked within the
+    # last INDEX_CHECK_INTERVAL seconds. Only files whose signature changed are
+    # hashed again.
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._last_check is not None and \
+           now - self._last_check < INDEX_CHECK_INTERVAL:
+            return
+        self._last_check = now
+
+        signatures = {}
+        for path in get_all_paths(self.version, ignore=self.ignore):
+            try:
+                full_path = os.path.join(self.version, path)
+                signatures[path] = get_file_signature(full_path)
+            except OSError:
+                pass  # The file was removed while scanning
+
+        signature = frozenset(signatures.items())
+        if signature == self._signature:
+            return
+
+        hashes = {}
+        for path in signatures:
+            try:
+                hashes[path] = get_file_hash(os.path.join(self.version, path))
+            except OSError:
+                pass  # The file was removed while hashing
+        self.hashes = hashes
+        self._signature = signature
+        self.generation += 1
+
+
+# Version indexes keyed by version number, least recently used first
+_version_indexes = collections.OrderedDict()
+_index_lock = threading.Lock()
+
+# Index of the versions that are not on the server, e.g. of a new client
+_empty_index = VersionIndex(None)
+
+
+# Returns the up to date VersionIndex of a version directory, or an empty
+# index if there is no such directory. Only versions in the catalogue are
+# indexed, the version is sent by the client.
+# Parameters
+#    version - The version number, i.e. the name of the version directory
+def get_version_index(version):
+    if not get_catalogue().has_version(version):
+        return _empty_index
+
+    with _index_lock:
+        index = _version_indexes.get(version)
+        if index is None:
+            index = VersionIndex(version)
+            _version_indexes[version] = index
+            if len(_version_indexes) > VERSION_INDEX_CACHE_SIZE:
+                _version_indexes.popitem(last=False)
+        else:
+            _version_indexes.move_to_end(version)
+    index.refresh()
+    return index
+
+
 # Returns a tuple containing three lists: deleted files, new_file, changed
 # files.
 # Parameters
-#    left - The original directory
-#    right - The directory with updates
-#    ignore - A list o file name which to ignore
-def get_diff_list(left, right, ignore=['.DS_Store', 'pymakr.conf']):
-    left_paths = get_all_paths(left, ignore=ignore)
-    right_paths = get_all_paths(right, ignore=ignore)
+#    left - The VersionIndex of the original directory
+#    right - The VersionIndex of the directory with updates
+def get_diff_list(left, right):
+    left_paths = set(left.hashes)
+    right_paths = set(right.hashes)
     new_files = right_paths.difference(left_paths)
     to_delete = left_paths.difference(right_paths)
     common = left_paths.intersection(right_paths)
 
-    to_update = []
-    for f in common:
-        if not filecmp.cmp(os.path.join(left, f),
-                           os.path.join(right, f),
-                           shallow=False):
-            to_update.append(f)
+    to_update = [f for f in common if left.hashes[f] != right.hashes[f]]
 
     return (to_delete, new_files, (to_update))
 
 
-# Searches the current working directory for a file starting with "firmware_"
-# followed by a version number higher than `current_ver` as per LooseVersion.
-# Returns None if such a file does not exist.
+# Returns the length of the common prefix of `a[a_pos:]` and `b[b_pos:]`
+def match_length(a, a_pos, b, b_pos):
+    length = 0
+    step = 4096
+    # Compare large slices first, then single bytes
+    while step > 0:
+        while a[a_pos + length:a_pos + length + step] == \
+              b[b_pos + length:b_pos + length + step] and \
+              a_pos + length + step <= len(a) and \
+              b_pos + length + step <= len(b):
+            length += step
+        step //= 8
+    return length
+
+
+# Returns a delta that turns the binary image `old` into `new` in the format
+# described at the top of this file. Blocks of `old` are indexed by content,
+# `new` is scanned for matching blocks which are extended as far as possible
+# in both directions. Everything that cannot be copied is sent literally.
 # Parameters
-#    path - the path to the directory to be searched
-#    current_ver - the result must be higher than this version
-#
-def get_new_firmware(path, current_ver):
-    latest = None
-    for f in os.listdir(path):
-        # Ignore directories
-        if not os.path.isfile(f):
+#    old - The content of the current image
+#    new - The content of the new image
+#    block_size - The size of the blocks of `old` that are indexed
+def make_delta(old, new, block_size=DELTA_BLOCK_SIZE):
+    blocks = {}
+    for offset in range(0, len(old) - block_size + 1, block_size):
+        blocks.setdefault(old[offset:offset + block_size], offset)
+
+    out = bytearray(b'OTAD')
+    out += struct.pack('>I', len(new))
+    literal_start = 0
+    pos = 0
+    while pos <= len(new) - block_size:
+        src = blocks.get(new[pos:pos + block_size])
+        if src is None:
+            pos += 1
             continue
 
+        # Extend the match backwards into the pending literal bytes
+        while pos > literal_start and src > 0 and \
+                new[pos - 1] == old[src - 1]:
+            pos -= 1
+            src -= 1
+
+        length = match_length(new, pos, old, src)
+        if pos > literal_start:
+            out += struct.pack('>BI', 2, pos - literal_start)
+            out += new[literal_start:pos]
+        out += struct.pack('>BII', 1, src, length)
+        pos += length
+        literal_start = pos
+
+    if literal_start < len(new):
+        out += struct.pack('>BI', 2, len(new) - literal_start)
+        out += new[literal_start:]
+    return bytes(out)
+
+
+# Deltas are generated one at a time by a background thread, the names of the
+# deltas queued or being generated are kept in `_delta_jobs`.
+# `delta_generation` is incremented whenever a delta is written, so that
+# manifests generated without it can be invalidated.
+_delta_queue = queue.Queue()
+_delta_jobs = set()
+_delta_lock = threading.Lock()
+_delta_th = None
+delta_generation = 0
+
+
+def _delta_worker():
+    global delta_generation
+    while True:
+        name, old_firmware, new_firmware = _delta_queue.get()
         try:
-            m = re.search(r'firmware_([0-9a-zA-Z.]+)(?=.bin|hex)', f)
-            version = m.group(1)
-            if LooseVersion(current_ver) < LooseVersion(version):
-                latest = f
-        except AttributeError:
-            # file does not match firmware naming scheme
-            pass
-    return latest
+            print("Generating delta {} -> {}".format(old_firmware,
+                                                     new_firmware))
+            with open(os.path.join('.', old_firmware), 'rb') as f:
+                old = f.read()
+            with open(os.path.join('.', new_firmware), 'rb') as f:
+                new = f.read()
+            write_cache_file(name, make_delta(old, new))
+            delta_generation += 1
+        except OSError as e:
+            print("Error generating delta {}: {}".format(name, e))
+        finally:
+            with _delta_lock:
+                _delta_jobs.discard(name)
+
+
+# Queues the generation of the delta `name`, unless it is already queued
+def queue_firmware_delta(name, old_firmware, new_firmware):
+    global _delta_th
+    with _delta_lock:
+        if name in _delta_jobs:
+            return
+        _delta_jobs.add(name)
+        if _delta_th is None:
+            _delta_th = threading.Thread(target=_delta_worker, daemon=True)
+            _delta_th.start()
+    _delta_queue.put((name, old_firmware, new_firmware))
+
+
+# Returns a manifest entry (without the host part of the URL) for a delta
+# from the firmware image `old_firmware` to `new_firmware`. Returns None if
+# there is no old image, the delta would not be smaller than the new image or
+# it is not in the cache yet, its generation is then queued and the full image
+# is used until it is ready.
+# Parameters
+#    old_firmware - The name of the firmware image on the client or None
+#    new_firmware - The name of the firmware image to update to
+def get_firmware_delta(old_firmware, new_firmware):
+    if old_firmware is None:
+        return None
+
+    src_hash = get_file_hash(os.path.join('.', old_firmware))
+    dst_hash = get_file_hash(os.path.join('.', new_firmware))
+    if src_hash == dst_hash:
+        return None
+
+    name = "{}_{}.delta".format(src_hash, dst_hash)
+    path = os.path.join(CACHE_DIR, name)
+    if not os.path.isfile(path):
+        queue_firmware_delta(name, old_firmware, new_firmware)
+        return None
+
+    if os.path.getsize(path) >= os.path.getsize(new_firmware):
+        return None
+
+    return {
+        "URL": "/".join((CACHE_DIR, name)),
+        "hash": get_file_hash(path),
+        "src_hash": src_hash,
+        "dst_hash": dst_hash
+    }
+
+
+# Queues the deltas from every firmware image to the newest one, called when
+# the server starts and whenever the catalogue changes.
+def precompute_firmware_deltas():
+    catalogue = get_catalogue()
+    newest = catalogue.resolve('0')[1]
+    if newest is None:
+        return
+    for f in catalogue.get_firmware_images():
+        if f != newest:
+            get_firmware_delta(f, newest)
+
+
+# Atomically writes `data` to the file `name` in the cache directory
+def write_cache_file(name, data):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, name)
+    tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# Returns the "compressed" part of a manifest entry (without the host part of
+# the URL) for the file `path` of the directory `version`, compressing it if it
+# is not in the cache yet. Returns None if compression does not make the file
+# smaller.
+# Parameters
+#    path - The relative path to the file
+#    version - The version number of the file
+#    index - The VersionIndex of `version`, used to look up the hash
+def get_compressed_entry(path, version, index):
+    name = "{}.z".format(index.hashes[path])
+    cache_path = os.path.join(CACHE_DIR, name)
+    if not os.path.isfile(cache_path):
+        with open(os.path.join('.', version, path), 'rb') as f:
+            data = f.read()
+        compressor = zlib.compressobj(9, zlib.DEFLATED, COMPRESS_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+        # Store incompressible files as empty markers so they are only
+        # compressed once
+        write_cache_file(name, compressed if len(compressed) < len(data)
+                         else b'')
+
+    size = os.path.getsize(cache_path)
+    if size == 0:
+        return None
+
+    return {
+        "URL": "/".join((CACHE_DIR, name)),
+        "hash": get_file_hash(cache_path),
+        "size": size,
+        "wbits": COMPRESS_WBITS
+    }
 
 
 # Returns a dict containing a manifest entry which contains the files
-# destination path, download URL and SHA1 hash.
+# destination path, download URL and SHA1 hash and, if it makes the file
+# smaller, the URL and SHA1 hash of its compressed form.
 # Parameters
 #    path - The relative path to the file
 #    version - The version number of the file
 #    host - The server address, used in URL formatting
-def generate_manifest_entry(host, path, version):
-    path = "/".join(path.split(os.path.sep))
+#    index - The VersionIndex of `version`, used to look up the hash
+def generate_manifest_entry(host, path, version, index):
     entry = {}
-    entry["dst_path"] = "/{}".format(path)
-    entry["URL"] = "http://{}/{}/{}".format(host, version, path)
-    data = open(os.path.join('.', version, path), 'rb').read()
-    hasher = hashlib.sha1(data)
-    entry["hash"] = hasher.hexdigest()
+    entry["dst_path"] = "/{}".format("/".join(path.split(os.path.sep)))
+    entry["URL"] = "http://{}/{}{}".format(host, version, entry["dst_path"])
+    entry["hash"] = index.hashes[path]
+    compressed = get_compressed_entry(path, version, index)
+    if compressed is not None:
+        compressed["URL"] = "http://{}/{}".format(host, compressed["URL"])
+        entry["compressed"] = compressed
     return entry
 
 
@@ -281,37 +988,108 @@ def generate_manifest_entry(host, path, version):
 #    version - The version that this manifest will bring the client up to
 #    firmware(optional) - A manifest entry for the new firmware, if one is
 #                         available.
-def generate_manifest(current_ver, host):
-    latest = get_latest_version()
-
+# Parameters
+#    current_ver - The version the client is currently on
+#    host - The server address, used in URL formatting
+#    latest - The version to update the client to
+#    new_firmware - The name of the firmware image to install or None
+#    delta - True if the client can apply firmware deltas
+def generate_manifest(current_ver, host, latest, new_firmware, delta=False):
     # If the current version is already the latest, there is nothing to do
     if latest == current_ver:
         return None
 
     # Get lists of difference between versions
-    to_delete, new_files, to_update = get_diff_list(current_ver, latest)
+    current_index = get_version_index(current_ver)
+    latest_index = get_version_index(latest)
+    to_delete, new_files, to_update = get_diff_list(current_index,
+                                                    latest_index)
 
     manifest = {
       "delete": list(to_delete),
-      "new": [generate_manifest_entry(host, f, latest) for f in new_files],
-      "update": [generate_manifest_entry(host, f, latest) for f in to_update],
+      "new": [generate_manifest_entry(host, f, latest, latest_index)
+              for f in new_files],
+      "update": [generate_manifest_entry(host, f, latest, latest_index)
+                 for f in to_update],
       "version": latest
     }
 
     # If there is a newer firmware version add it to the manifest
-    new_firmware = get_new_firmware('.', current_ver)
     if new_firmware is not None:
         entry = {}
         entry["URL"] = "http://{}/{}".format(host, new_firmware)
-        data = open(os.path.join('.', new_firmware), 'rb').read()
-        hasher = hashlib.sha1(data)
-        entry["hash"] = hasher.hexdigest()
+        entry["hash"] = get_file_hash(os.path.join('.', new_firmware))
+        if delta:
+            delta = get_firmware_delta(
+                get_catalogue().get_firmware(current_ver), new_firmware)
+        if delta:
+            delta["URL"] = "http://{}/{}".format(host, delta["URL"])
+            entry["delta"] = delta
         manifest["firmware"] = entry
 
     return manifest
 
 
+# Cache of generated manifests keyed by (current version, target version,
+# firmware image, delta support), least recently used first. Versions the
+# server does not know all get the same manifest and share the key of None.
+# Each entry holds the state the manifest was generated from, used to check
+# that it is still valid, and the serialised manifest split at the host name.
+_manifest_cache = collections.OrderedDict()
+_manifest_lock = threading.Lock()
+
+# Generated in place of the host name, serialised as "\u0000" which no path
+# can contain
+HOST_PLACEHOLDER = '\x00'
+
+
+# Returns the update manifest from `current_ver` to the target version of the
+# client, serialised as JSON. Manifests are generated once and then served from
+# `_manifest_cache` until the content of one of the two version directories
+# or the firmware images change, the host name is filled in for each request.
+# Parameters
+#    current_ver - The version the client is currently on
+#    host - The server address, used in URL formatting
+#    channel - The release channel of the client or None
+#    device_id - The identifier of the client or None
+#    delta - True if the client can apply firmware deltas
+def get_manifest_json(current_ver, host, channel=None, device_id=None,
+                      delta=False):
+    catalogue = get_catalogue()
+    latest, new_firmware = catalogue.resolve(current_ver, channel, device_id)
+    old_firmware = catalogue.get_firmware(current_ver)
+    state = (get_version_index(current_ver).generation,
+             get_version_index(latest).generation,
+             [(f, get_file_signature(os.path.join('.', f)))
+              for f in (new_firmware, old_firmware) if f is not None],
+             delta_generation if delta else None)
+
+    known = catalogue.has_version(current_ver) or old_firmware is not None
+    key = (current_ver if known else None, latest, new_firmware, delta)
+    with _manifest_lock:
+        cached = _manifest_cache.get(key)
+        if cached is not None and cached[0] == state:
+            _manifest_cache.move_to_end(key)
+
+    if cached is None or cached[0] != state:
+        manifest = generate_manifest(current_ver, HOST_PLACEHOLDER, latest,
+                                     new_firmware, delta)
+        j = json.dumps(manifest,
+                       sort_keys=True,
+                       indent=4,
+                       separators=(',', ': '))
+        cached = (state, j.split(json.dumps(HOST_PLACEHOLDER)[1:-1]))
+        with _manifest_lock:
+            _manifest_cache[key] = cached
+            _manifest_cache.move_to_end(key)
+            if len(_manifest_cache) > MANIFEST_CACHE_SIZE:
+                _manifest_cache.popitem(last=False)
+
+    return json.dumps(str(host))[1:-1].join(cached[1]).encode()
+
+
 if __name__ == "__main__":
     server_address = ('', PORT)
-    httpd = HTTPServer(server_address, OTAHandler)
+    precompute_firmware_deltas()
+    httpd = OTAServer(server_address, OTAHandler)
     httpd.serve_forever()